@@ -30,21 +30,47 @@ following copyright and licensing notice:
 ##############################################################################
 """
 
+import array
 import binascii
+import copy
+import difflib
 import doctest
+import hashlib
+import heapq
+import itertools
+import marshal
+import optparse
 import os
 import re
+import repr as reprlib
+import struct
 import sys
+import tempfile
+import threading
 import time
 import traceback
+import types
 import unittest
 import warnings
 
 import nose.config
 import nose.core
+import nose.loader
 import nose.plugins
+import nose.plugins.manager
+import nose.suite
 import nose.util
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 # TODO
 # syntax-highlight traceback Python source lines
 
@@ -143,6 +169,11 @@ class Xterm256Color(object):
     def terminal_code(self):
         return "\033[38;5;%dm" % self._code
 
+    def apply_to(self, state):
+        """Return the (bold, foreground) terminal state that results from
+        emitting this colour's terminal code in ``state``."""
+        return state[0], ("xterm", self._code)
+
 
 class Ansi16Color(object):
 
@@ -167,6 +198,14 @@ class Ansi16Color(object):
             prefix_code = "0;"
         return "\033[%s%sm" % (prefix_code, fg_code)
 
+    def apply_to(self, state):
+        """Return the (bold, foreground) terminal state that results from
+        emitting this colour's terminal code in ``state``."""
+        if self._fg_color is None or self._bright is False:
+            # the code starts with (or is) a full reset
+            return False, self._fg_color
+        return bool(self._bright) or state[0], self._fg_color
+
 
 def parse_color(color_text):
     """
@@ -363,8 +402,1387 @@ def elide_foreign_path_and_line_nr(base_dir, path, line_nr):
         return relpath, line_nr
 
 
+def summarize_problems(errors, failures, error_classes):
+    """Return an ordered mapping of problem labels to counts, for the
+    summary of an unsuccessful test run."""
+    summary = nose.util.odict()
+    summary["failures"], summary["errors"] = map(len, [failures, errors])
+    for storage, label, isfail in error_classes:
+        if not isfail:
+            continue
+        summary[label] = len(storage)
+    return summary
+
+
+def fixture_subject(test):
+    """Return the module or class whose fixture failed if ``test`` is the
+    suite nose reports fixture errors against, otherwise ``test`` itself."""
+    if isinstance(test, nose.suite.ContextSuite) and test.context is not None:
+        return test.context
+    return test
+
+
+def source_file(test):
+    """Return the source file ``test`` was loaded from, or None."""
+    filename = nose.util.test_address(fixture_subject(test))[0]
+    if filename is not None:
+        filename = normalize_path(nose.util.src(filename))
+    return filename
+
+
+def loadable_name(test):
+    """Return a name nose can load ``test`` from again.
+
+    >>> def test_spam(): pass
+    >>> path, call = loadable_name(test_spam).split(":")
+    >>> os.path.basename(path), call
+    ('rudolf.py', 'test_spam')
+
+    For a fixture error, that is the module or class whose fixture failed:
+
+    >>> suite = nose.suite.ContextSuite(context=doctest)
+    >>> os.path.basename(loadable_name(suite))
+    'doctest.py'
+    """
+    filename, module, call = nose.util.test_address(fixture_subject(test))
+    if filename is not None:
+        name = normalize_path(nose.util.src(filename))
+    else:
+        name = module
+    if call:
+        name = "%s:%s" % (name, call)
+    return name
+
+
+def rerunnable_name(test):
+    """Return a name that loads just ``test`` again, or None if there is no
+    such name (e.g. for doctests and fixture errors).
+
+    Fixture errors are reported against the suite of the module or class
+    whose fixture failed, which can't be run on its own again:
+
+    >>> print rerunnable_name(unittest.TestSuite())
+    None
+    """
+    if not hasattr(test, "address") or isinstance(test, unittest.TestSuite):
+        return None
+    if nose.util.test_address(test)[2] is None:
+        return None
+    return loadable_name(test)
+
+
+def run_again(loader, name, times):
+    """Run the test called ``name`` up to ``times`` times, until it passes.
+
+    Returns True if it passed.  Only a name that loads exactly one test
+    counts as passing.
+    """
+    for attempt in range(times):
+        result = unittest.TestResult()
+        loader.loadTestsFromName(name)(result)
+        if result.testsRun == 1 and result.wasSuccessful():
+            return True
+    return False
+
+
+class FlakyTest(Exception):
+    """Key of the error class for tests that failed, then passed when run
+    again by --color-rerun."""
+
+
 class DocTestFailureException(AssertionError):
-    """Custom exception for doctest unit test failures."""
+    """Custom exception for doctest unit test failures.
+
+    When raised by ``run_doctest_case``, the message is just the heading
+    naming the doctest, and ``doctest_failures`` holds a record of each
+    failed example (see ``RecordingDocTestRunner``).  The full text report
+    is only formatted if somebody asks for it.
+    """
+
+    doctest_failures = None
+
+    def __str__(self):
+        message = AssertionError.__str__(self)
+        if self.doctest_failures is None:
+            return message
+        return message + "".join(map(format_doctest_failure,
+                                     self.doctest_failures))
+
+
+# A failed doctest example, as recorded by RecordingDocTestRunner:
+#   (filename, line number, test name, source, want, got, exception,
+#    diff kind, diff lines)
+# filename is None for doctests that don't come from a file, and the line
+# number is then relative to the doctest.  exception is the formatted
+# traceback of an unexpected exception, and got is None in that case.
+# diff kind is the kind of difference doctest reports (e.g. "ndiff with
+# -expected +actual"), or None when want and got are shown in full.
+
+class RecordingDocTestRunner(doctest.DocTestRunner):
+    """DocTestRunner that records failed examples instead of writing a
+    text report of them."""
+
+    def __init__(self, *args, **kwds):
+        doctest.DocTestRunner.__init__(self, *args, **kwds)
+        self.failed_examples = []
+
+    def report_failure(self, out, test, example, got):
+        want = example.want
+        if not (self.optionflags & doctest.DONT_ACCEPT_BLANKLINE):
+            got = re.sub("(?m)^[ ]*(?=\n)", doctest.BLANKLINE_MARKER, got)
+        diff_kind, diff_lines = self._difference(want, got)
+        self.failed_examples.append(self._failure(test, example) +
+                             (got, None, diff_kind, diff_lines))
+
+    def report_unexpected_exception(self, out, test, example, exc_info):
+        exception = "".join(traceback.format_exception(*exc_info))
+        self.failed_examples.append(self._failure(test, example) +
+                             (None, exception, None, None))
+
+    def _failure(self, test, example):
+        if test.filename:
+            if test.lineno is not None and example.lineno is not None:
+                lineno = test.lineno + example.lineno + 1
+            else:
+                lineno = "?"
+        else:
+            lineno = example.lineno + 1
+        return (test.filename or None, lineno, test.name, example.source,
+                example.want)
+
+    def _difference(self, want, got):
+        # what doctest.OutputChecker.output_difference does, without
+        # formatting the result
+        flags = self.optionflags
+        if not self._checker._do_a_fancy_diff(want, got, flags):
+            return None, None
+        want_lines = want.splitlines(True)
+        got_lines = got.splitlines(True)
+        if flags & doctest.REPORT_UDIFF:
+            diff = list(difflib.unified_diff(want_lines, got_lines, n=2))[2:]
+            kind = "unified diff with -expected +actual"
+        elif flags & doctest.REPORT_CDIFF:
+            diff = list(difflib.context_diff(want_lines, got_lines, n=2))[2:]
+            kind = "context diff with expected followed by actual"
+        else:
+            engine = difflib.Differ(charjunk=difflib.IS_CHARACTER_JUNK)
+            diff = engine.compare(want_lines, got_lines)
+            kind = "ndiff with -expected +actual"
+        return kind, [line.rstrip() for line in diff]
+
+
+def format_doctest_failure(failure):
+    """Return the text doctest would have reported for a failed example."""
+    (filename, lineno, name, source, want, got, exception,
+     diff_kind, diff_lines) = failure
+    lines = ["-" * 70]
+    if filename is not None:
+        lines.append('File "%s", line %s, in %s' % (filename, lineno, name))
+    else:
+        lines.append("Line %s, in %s" % (lineno, name))
+    lines.append("Failed example:")
+    lines.append(doctest._indent(source))
+    text = "\n".join(lines)
+    if exception is not None:
+        return text + "Exception raised:\n" + doctest._indent(exception)
+    if diff_kind is not None:
+        diff = "".join([line + "\n" for line in diff_lines])
+        return text + "Differences (%s):\n" % diff_kind + doctest._indent(diff)
+    if want and got:
+        return text + "Expected:\n%sGot:\n%s" % (doctest._indent(want),
+                                                 doctest._indent(got))
+    elif want:
+        return text + "Expected:\n%sGot nothing\n" % doctest._indent(want)
+    elif got:
+        return text + "Expected nothing\nGot:\n%s" % doctest._indent(got)
+    else:
+        return text + "Expected nothing\nGot nothing\n"
+
+
+def run_doctest_case(self):
+    """Replacement for doctest.DocTestCase.runTest that raises failures
+    with a record of the failed examples attached.
+
+    Doctests that use an output checker with its own way of reporting
+    differences, or that don't fail with DocTestFailureException, are run
+    as usual.
+    """
+    checker = self._dt_checker
+    if (not issubclass(self.failureException, DocTestFailureException) or
+        (checker is not None and
+         type(checker).output_difference.im_func is not
+         doctest.OutputChecker.output_difference.im_func)):
+        return _original_doctest_run_test(self)
+    test = self._dt_test
+    old = sys.stdout
+    optionflags = self._dt_optionflags
+    if not (optionflags & doctest.REPORTING_FLAGS):
+        optionflags |= doctest._unittest_reportflags
+    runner = RecordingDocTestRunner(optionflags=optionflags,
+                                    checker=checker, verbose=False)
+    try:
+        failures, tries = runner.run(test, out=lambda text: None,
+                                     clear_globs=False)
+    finally:
+        sys.stdout = old
+    if failures:
+        exc = self.failureException(self.format_failure(""))
+        exc.doctest_failures = runner.failed_examples
+        raise exc
+
+_original_doctest_run_test = doctest.DocTestCase.runTest.im_func
+
+
+# Events written by EventRecorder.  Each is recorded as a tuple starting with
+# the event code and the time of the event:
+#   EVENT_BEGIN, time, log format version
+#   EVENT_START, time, description
+#   EVENT_SUCCESS, time
+#   EVENT_FAILURE, time, formatted traceback, is doctest failure,
+#     failed doctest examples
+#   EVENT_ERROR, time, formatted traceback, is doctest failure, label, isfail
+#   EVENT_SKIP, time, label, reason
+#   EVENT_STOP, time
+#   EVENT_END, time
+#   EVENT_SHARD, time, shard number (from 1), number of shards
+#   EVENT_DURATIONS, time, {test file: seconds}
+#   EVENT_FLAKY, time, description of a failed test that passed when run
+#     again by --color-rerun
+(EVENT_BEGIN, EVENT_START, EVENT_SUCCESS, EVENT_FAILURE, EVENT_ERROR,
+ EVENT_SKIP, EVENT_STOP, EVENT_END, EVENT_SHARD, EVENT_DURATIONS,
+ EVENT_FLAKY) = range(11)
+# Version 2 added the failed doctest examples (see RecordingDocTestRunner)
+# to EVENT_FAILURE; they are None for other failures.  Version 3 added
+# EVENT_SHARD and EVENT_DURATIONS, and version 4 EVENT_FLAKY.
+LOG_FORMAT_VERSION = 4
+
+_block_length = struct.Struct("<I")
+
+
+class EventRecorder(object):
+    """Append test run events to a binary log file.
+
+    Events are collected into blocks, and each block is appended to the log
+    as a marshalled list of events preceded by its length, so that a log can
+    be read back a block at a time (see ``read_events``).
+    """
+
+    block_size = 1000
+
+    def __init__(self, path):
+        self._file = open(path, "ab")
+        self._events = []
+
+    def record(self, *event):
+        self._events.append(event)
+        if len(self._events) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._events:
+            data = marshal.dumps(self._events)
+            self._file.write(_block_length.pack(len(data)) + data)
+            self._file.flush()
+            self._events = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class ThreadSafeRecorder(object):
+    """Wraps an EventRecorder for tests that run in several threads at once.
+
+    A test's events are held back until it stops and then recorded
+    together, so that in the log each outcome follows the start of its own
+    test rather than whichever test started last.  Events recorded outside
+    of a test (e.g. for fixture errors) are recorded straight away.
+    """
+
+    def __init__(self, recorder):
+        self._recorder = recorder
+        self._lock = threading.Lock()
+        # thread ident: the events of the test running in it
+        self._pending = {}
+
+    def record(self, *event):
+        ident = threading.currentThread().ident
+        if event[0] == EVENT_START:
+            self._pending[ident] = [event]
+            return
+        events = self._pending.get(ident)
+        if events is None:
+            events = [event]
+        else:
+            events.append(event)
+            if event[0] != EVENT_STOP:
+                return
+            del self._pending[ident]
+        self._lock.acquire()
+        try:
+            for event in events:
+                self._recorder.record(*event)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._recorder.close()
+        finally:
+            self._lock.release()
+
+
+def read_events(log_file):
+    """Yield the events recorded in an open log file.
+
+    A truncated final block (left by a run that was killed) is ignored.
+
+    >>> from cStringIO import StringIO
+    >>> log = StringIO()
+    >>> data = marshal.dumps([(EVENT_START, 1.0, "spam"),
+    ...                       (EVENT_SUCCESS, 2.0)])
+    >>> log.write(_block_length.pack(len(data)) + data)
+    >>> log.write(_block_length.pack(10) + "eggs")
+    >>> log.seek(0)
+    >>> for event in read_events(log):
+    ...     print event
+    (1, 1.0, 'spam')
+    (2, 2.0)
+    """
+    size = _block_length.size
+    while True:
+        header = log_file.read(size)
+        if len(header) < size:
+            return
+        length, = _block_length.unpack(header)
+        data = log_file.read(length)
+        if len(data) < length:
+            return
+        for event in marshal.loads(data):
+            yield event
+
+
+_method_description = re.compile(r"^(\w+) \(([\w.]+)\)$")
+
+
+def split_description(description):
+    """Split a test description into the name of the group the test belongs
+    to (its module or class) and the rest, or return None if it has none.
+
+    >>> split_description("test_thing (test_fixtures.TestThing)")
+    ('test_fixtures.TestThing', 'test_thing')
+    >>> split_description("pkg.test_module.test_function")
+    ('pkg.test_module', 'test_function')
+    >>> split_description("pkg.test_module.test_generator(1, 'a.b')")
+    ('pkg.test_module', "test_generator(1, 'a.b')")
+    >>> print split_description("Doctest: spam.rst")
+    None
+    """
+    match = _method_description.match(description)
+    if match is not None:
+        return match.group(2), match.group(1)
+    name, paren, arguments = description.partition("(")
+    if " " in name or "." not in name:
+        return None
+    group, dot, item = name.rpartition(".")
+    return group, item + paren + arguments
+
+
+class RecordedTest(object):
+    """Stand-in for a test that is only known by its description."""
+
+    def __init__(self, description):
+        self._description = description
+
+    def shortDescription(self):
+        return self._description
+
+    def __str__(self):
+        return self._description
+
+
+class SpillBudget(object):
+    """The memory the FailureStores of a test run may use between them."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+
+class FailureStore(object):
+    """Append-only sequence of failure records, kept on disk once they
+    use more than their budget of memory.
+
+    Records are tuples of a test, its formatted traceback (or skip
+    reason), and optionally the exception type and further details, as
+    kept in nose's result lists and ``errorClasses`` storage.  When the
+    records held in memory by all the stores sharing ``budget`` take up
+    more than its limit, the store being appended to moves its records to
+    an anonymous temporary file.  Records read back from disk have a
+    RecordedTest (made from the test's description) in place of the test.
+
+    >>> store = FailureStore(SpillBudget(300), describe=str)
+    >>> store.append(("test_one", "x" * 80, AssertionError))
+    >>> store.spilled
+    0
+    >>> store.append(("test_two", "y" * 80, ValueError, None))
+    >>> store.spilled
+    2
+    >>> store.append(("test_three", "reason"))
+    >>> len(store), store.spilled
+    (3, 2)
+    >>> for record in store:
+    ...     print [str(item)[:20] for item in record]
+    ['test_one', 'xxxxxxxxxxxxxxxxxxxx', "<type 'exceptions.As"]
+    ['test_two', 'yyyyyyyyyyyyyyyyyyyy', "<type 'exceptions.Va", 'None']
+    ['test_three', 'reason']
+    >>> store.close()
+    """
+
+    # rough memory cost of a record, besides the text it holds
+    record_overhead = 100
+
+    def __init__(self, budget, describe):
+        self._budget = budget
+        self._describe = describe
+        self._records = []
+        self._size = 0
+        self._file = None
+        self.spilled = 0
+        # exception types are written to disk as indices into this list
+        self._types = []
+        self._type_indices = {}
+
+    def __len__(self):
+        return self.spilled + len(self._records)
+
+    def append(self, record):
+        self._records.append(record)
+        size = self._record_size(record)
+        self._size += size
+        self._budget.used += size
+        if self._budget.used > self._budget.limit:
+            self._spill()
+
+    def _record_size(self, record):
+        size = self.record_overhead
+        for item in record[1:]:
+            if isinstance(item, basestring):
+                size += len(item)
+        if len(record) > 3 and record[3]:
+            for failure in record[3]:
+                for field in failure:
+                    if isinstance(field, basestring):
+                        size += len(field)
+                    elif isinstance(field, list):
+                        size += sum(map(len, field))
+        return size
+
+    def _spill(self):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+        spilled = []
+        for record in self._records:
+            text = record[1]
+            if not isinstance(text, basestring):
+                # a skip reason
+                text = str(text)
+            err_type = details = None
+            if len(record) > 2:
+                err_type = self._type_index(record[2])
+            if len(record) > 3:
+                details = record[3]
+            spilled.append((self._describe(record[0]), text, err_type,
+                            details, len(record)))
+        data = marshal.dumps(spilled)
+        self._file.seek(0, 2)
+        self._file.write(_block_length.pack(len(data)) + data)
+        self.spilled += len(self._records)
+        self._budget.used -= self._size
+        self._records = []
+        self._size = 0
+
+    def _type_index(self, err_type):
+        try:
+            return self._type_indices[err_type]
+        except KeyError:
+            index = self._type_indices[err_type] = len(self._types)
+            self._types.append(err_type)
+            return index
+
+    def __iter__(self):
+        if self._file is not None:
+            self._file.seek(0)
+            for description, text, err_type, details, length in \
+                    read_events(self._file):
+                record = (RecordedTest(description), text)
+                if length > 2:
+                    record += (self._types[err_type],)
+                if length > 3:
+                    record += (details,)
+                yield record
+        for record in self._records:
+            yield record
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def format_bytes(n_bytes):
+    """Format a (possibly negative) number of bytes for display.
+
+    >>> format_bytes(512)
+    '512 B'
+    >>> format_bytes(3 * 1024 * 1024 + 1)
+    '3.0 MB'
+    >>> format_bytes(-2048)
+    '-2.0 KB'
+    """
+    if abs(n_bytes) < 1024:
+        return "%d B" % n_bytes
+    size = n_bytes / 1024.0
+    for unit in ["KB", "MB"]:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GB" % size
+
+
+class MemoryTracker(object):
+    """Measure the memory each test leaves behind.
+
+    Process RSS (read from /proc/self/statm) and, if asked for and
+    available, the memory traced by the tracemalloc module are sampled when
+    a test starts and again when it stops.  Only every ``interval``th test
+    is sampled.  The ``top`` tests with the largest growth are kept, along
+    with the total growth of each module.
+    """
+
+    statm_path = "/proc/self/statm"
+
+    def __init__(self, describe, interval=1, top=10, trace=False):
+        self._describe = describe
+        self.interval = max(1, interval)
+        self.top = top
+        try:
+            self._statm = open(self.statm_path)
+            self._page_size = os.sysconf("SC_PAGE_SIZE")
+        except (EnvironmentError, AttributeError, ValueError):
+            self._statm = None
+        self._trace = trace and tracemalloc is not None
+        self._started_tracing = False
+        if self._trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.columns = []
+        if self._statm is not None:
+            self.columns.append("RSS")
+        if self._trace:
+            self.columns.append("traced")
+        self.tests_seen = 0
+        self.tests_sampled = 0
+        self._sample = None
+        # min-heap of (growth, sequence number, description)
+        self._largest = []
+        # module name -> list of growth totals, one per column
+        self._modules = {}
+        self.start = self.sample()
+
+    def enabled(self):
+        return bool(self.columns)
+
+    def sample(self):
+        """Return the current memory use, one number per column."""
+        values = []
+        if self._statm is not None:
+            self._statm.seek(0)
+            resident = int(self._statm.read().split()[1])
+            values.append(resident * self._page_size)
+        if self._trace:
+            values.append(tracemalloc.get_traced_memory()[0])
+        return tuple(values)
+
+    def start_test(self, test):
+        self.tests_seen += 1
+        if self.tests_seen % self.interval:
+            self._sample = None
+        else:
+            self._sample = self.sample()
+
+    def stop_test(self, test):
+        before = self._sample
+        if before is None:
+            return
+        self._sample = None
+        growth = tuple([after - b for b, after in zip(before, self.sample())])
+        self.tests_sampled += 1
+        if len(self._largest) < self.top:
+            heapq.heappush(self._largest, (growth, self.tests_sampled,
+                                           self._describe(test)))
+        elif growth > self._largest[0][0]:
+            heapq.heapreplace(self._largest, (growth, self.tests_sampled,
+                                              self._describe(test)))
+        module = nose.util.test_address(test)[1]
+        try:
+            totals = self._modules[module]
+        except KeyError:
+            totals = self._modules[module] = [0] * len(growth)
+        for index, value in enumerate(growth):
+            totals[index] += value
+
+    def total_growth(self):
+        return tuple([after - before for before, after in
+                      zip(self.start, self.sample())])
+
+    def largest_tests(self):
+        """Return (growth, description) pairs for the tests that grew most."""
+        largest = sorted(self._largest, reverse=True)
+        return [(growth, description) for growth, _, description in largest
+                if max(growth) > 0]
+
+    def largest_modules(self):
+        """Return (growth, module name) pairs for the modules that grew
+        most."""
+        modules = [(tuple(totals), module) for module, totals in
+                   self._modules.iteritems() if max(totals) > 0]
+        modules.sort(reverse=True)
+        return modules[:self.top]
+
+    def close(self):
+        if self._statm is not None:
+            self._statm.close()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+
+def thread_stacks():
+    """Return (thread name, formatted stack) pairs for every thread except
+    the calling one."""
+    frames = sys._current_frames()
+    current = threading.currentThread()
+    stacks = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        if thread is current or frame is None:
+            continue
+        stacks.append((thread.getName(),
+                       "".join(traceback.format_stack(frame))))
+    return stacks
+
+
+class HangWatchdog(object):
+    """Report tests that run for longer than ``timeout`` seconds.
+
+    A daemon thread sleeps until the current test is due to finish, and then
+    calls ``report(test, elapsed)``, again every ``repeat`` seconds if
+    ``repeat`` is non-zero.  Starting a test costs a single assignment, so
+    normal tests are not slowed down; ``report`` and ``stop_test`` are
+    serialized by ``lock``.
+    """
+
+    def __init__(self, report, timeout, repeat=0):
+        self._report = report
+        self.timeout = timeout
+        self.repeat = repeat
+        self.lock = threading.Lock()
+        # (test, start time), replaced as a whole so no lock is needed
+        self._current = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="rudolf hang watchdog")
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def start_test(self, test):
+        self._current = test, time.time()
+
+    def stop_test(self):
+        self.lock.acquire()
+        try:
+            self._current = None
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            self._current = None
+            self._stopped = True
+        finally:
+            self.lock.release()
+
+    def _run(self):
+        # Sleeping for at most self.timeout means a test that starts while
+        # we sleep is never noticed late.
+        last = due = None
+        while not self._stopped:
+            current = self._current
+            if current is not last:
+                last = current
+                due = None
+                if current is not None:
+                    due = current[1] + self.timeout
+            now = time.time()
+            if due is None:
+                delay = self.timeout
+            elif now >= due:
+                self._check(current, now)
+                due = None
+                if self.repeat:
+                    due = now + self.repeat
+                continue
+            else:
+                delay = min(due - now, self.timeout)
+            time.sleep(delay)
+
+    def _check(self, current, now):
+        self.lock.acquire()
+        try:
+            if not self._stopped and self._current is current:
+                test, start = current
+                self._report(test, now - start)
+        finally:
+            self.lock.release()
+
+
+def context_name(context):
+    """Return a name for a module, package or class used as a nose context.
+
+    >>> context_name(EventRecorder)
+    'rudolf.EventRecorder'
+    >>> context_name(sys.modules["os.path"]) == os.path.__name__
+    True
+    """
+    if isinstance(context, (type, types.ClassType)):
+        return "%s.%s" % (context.__module__, context.__name__)
+    return getattr(context, "__name__", str(context))
+
+
+class PhaseTimer(object):
+    """Divide the time taken by a test run between its phases.
+
+    Each event says what the time since the previous event was spent on,
+    and what happens next.  Time not spent importing, running fixtures,
+    running tests or reporting is counted as collection: finding and
+    loading tests, and nose's own work between tests.  The time spent in the
+    setup and teardown of each context (module, package or class) is also
+    totalled.
+
+    >>> timer = PhaseTimer(now=0)
+    >>> timer.start_context(EventRecorder, now=1)
+    >>> timer.start_test(now=3)
+    >>> timer.stop_test(now=4)
+    >>> timer.stop_context(EventRecorder, now=7)
+    >>> [(phase, timer.totals[phase]) for phase in timer.phases]
+    ...     # doctest: +NORMALIZE_WHITESPACE
+    [('collection', 1.0), ('import', 0.0), ('setup', 2.0), ('test', 1.0),
+     ('teardown', 3.0), ('report', 0.0)]
+    >>> timer.largest_fixtures()
+    [(5.0, 2.0, 3.0, 'rudolf.EventRecorder')]
+    """
+
+    phases = ["collection", "import", "setup", "test", "teardown", "report"]
+
+    def __init__(self, now=None):
+        if now is None:
+            now = time.time()
+        self.totals = dict.fromkeys(self.phases, 0.0)
+        # context name -> [setup time, teardown time]
+        self.fixtures = {}
+        # (context, name) for contexts that have been set up, innermost last
+        self._contexts = []
+        self._phase = "collection"
+        self._last = now
+
+    def _mark(self, spent_on, phase, now):
+        if now is None:
+            now = time.time()
+        elapsed = float(now - self._last)
+        self._last = now
+        if spent_on is None:
+            spent_on = self._phase
+        self.totals[spent_on] += elapsed
+        if spent_on == "setup" and self._contexts:
+            self._fixture(self._contexts[-1][1])[0] += elapsed
+        self._phase = phase
+        return elapsed
+
+    def _fixture(self, name):
+        try:
+            return self.fixtures[name]
+        except KeyError:
+            times = self.fixtures[name] = [0.0, 0.0]
+            return times
+
+    def start_import(self, now=None):
+        self._mark(None, "import", now)
+
+    def stop_import(self, now=None):
+        self._mark("import", "collection", now)
+
+    def start_context(self, context, now=None):
+        self._mark(None, "setup", now)
+        self._contexts.append((context, context_name(context)))
+
+    def stop_context(self, context, now=None):
+        elapsed = self._mark("teardown", "collection", now)
+        # nose doesn't stop contexts whose setup failed
+        for index in range(len(self._contexts) - 1, -1, -1):
+            if self._contexts[index][0] is context:
+                name = self._contexts[index][1]
+                del self._contexts[index:]
+                break
+        else:
+            name = context_name(context)
+        self._fixture(name)[1] += elapsed
+
+    def start_test(self, now=None):
+        self._mark(None, "test", now)
+
+    def stop_test(self, now=None):
+        self._mark("test", "collection", now)
+
+    def start_report(self, now=None):
+        self._mark(None, "report", now)
+
+    def stop_report(self, now=None):
+        self._mark("report", "collection", now)
+
+    def total(self):
+        return sum(self.totals.itervalues())
+
+    def largest_fixtures(self, top=10):
+        """Return (total, setup, teardown, context name) tuples for the
+        contexts with the most expensive fixtures."""
+        fixtures = [(setup + teardown, setup, teardown, name)
+                    for name, (setup, teardown) in self.fixtures.iteritems()
+                    if setup + teardown > 0]
+        fixtures.sort(reverse=True)
+        return fixtures[:top]
+
+
+def median(values):
+    """
+    >>> median([3, 1, 2]), median([4, 1, 2, 3])
+    (2, 2.5)
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class TimingDatabase(object):
+    """How long the tests took in past runs, kept in an SQLite database.
+
+    Each test has a row of its own, holding its durations in the last
+    ``history`` runs it took part in and their median, so the database
+    stays about as big as the test suite however many runs it has seen.
+    Tests that haven't run in the last ``keep_runs`` runs are removed, and
+    the space they took is given back.
+
+    >>> db = TimingDatabase(":memory:", history=3, keep_runs=2)
+    >>> for run in range(4):
+    ...     db.add_run(1000 + run, {"test_a": 1.0 + run, "test_b": 0.5})
+    >>> sorted(db.medians().items())
+    [('test_a', 3.0), ('test_b', 0.5)]
+    >>> db.add_run(1004, {"test_b": 0.5})
+    >>> db.add_run(1005, {"test_b": 0.5})
+    >>> db.medians(min_samples=2, tests=["test_a", "test_b"])
+    {'test_b': 0.5}
+    >>> db.close()
+    """
+
+    # durations are kept as single precision floats
+    _typecode = "f"
+
+    def __init__(self, path, history=20, keep_runs=100):
+        self.history = history
+        self.keep_runs = keep_runs
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = str
+        # only takes effect before the tables are created
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # (the durations table is left by earlier versions, which kept a
+        # row for each test in each run)
+        self.connection.executescript("""
+            DROP TABLE IF EXISTS durations;
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                started REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS tests (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                last_run INTEGER NOT NULL,
+                median REAL NOT NULL,
+                samples INTEGER NOT NULL,
+                durations BLOB NOT NULL);
+            """)
+
+    def medians(self, min_samples=1, tests=None):
+        """Return the median duration of each test over its last
+        ``history`` runs, for the tests that ran at least ``min_samples``
+        times (and are in ``tests``, if given)."""
+        rows = self.connection.execute(
+            "SELECT name, median FROM tests WHERE samples >= ?",
+            (min_samples,))
+        if tests is None:
+            return dict(rows)
+        return dict([(name, seconds) for name, seconds in rows
+                     if name in tests])
+
+    def add_run(self, started, durations):
+        """Add a run, given a mapping of test ids to seconds.
+
+        The run is written, and the tests that are no longer run removed,
+        in one transaction.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("INSERT INTO runs (started) VALUES (?)",
+                           (started,))
+            run = cursor.lastrowid
+            updated = []
+            known = set()
+            for test_id, name, data in cursor.execute(
+                "SELECT id, name, durations FROM tests").fetchall():
+                seconds = durations.get(name)
+                if seconds is None:
+                    continue
+                known.add(name)
+                recent = array.array(self._typecode)
+                recent.fromstring(str(data))
+                recent.append(seconds)
+                updated.append(self._row(run, recent[-self.history:]) +
+                               (test_id,))
+            cursor.executemany("UPDATE tests SET last_run = ?, median = ?, "
+                               "samples = ?, durations = ? WHERE id = ?",
+                               updated)
+            cursor.executemany(
+                "INSERT INTO tests (last_run, median, samples, durations, "
+                "name) VALUES (?, ?, ?, ?, ?)",
+                [self._row(run, array.array(self._typecode, [seconds])) +
+                 (name,) for name, seconds in durations.iteritems()
+                 if name not in known])
+            oldest = run - self.keep_runs
+            cursor.execute("DELETE FROM tests WHERE last_run <= ?", (oldest,))
+            removed = cursor.rowcount
+            cursor.execute("DELETE FROM runs WHERE id <= ?", (oldest,))
+        except:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        if removed > 0:
+            self.connection.execute("PRAGMA incremental_vacuum").fetchall()
+
+    def _row(self, run, recent):
+        return (run, median(recent), len(recent), buffer(recent.tostring()))
+
+    def close(self):
+        self.connection.close()
+
+
+def referenced_modules(module):
+    """Return the names of the modules that the globals of ``module`` are,
+    or come from.
+
+    >>> module = types.ModuleType("spam")
+    >>> module.os = os
+    >>> module.OptionParser = optparse.OptionParser
+    >>> sorted(referenced_modules(module))
+    ['optparse', 'os']
+    """
+    names = set()
+    for value in vars(module).values():
+        if isinstance(value, types.ModuleType):
+            names.add(value.__name__)
+            continue
+        try:
+            name = getattr(value, "__module__", None)
+        except Exception:
+            continue
+        if isinstance(name, str):
+            names.add(name)
+    return names
+
+
+class DependencyCache(object):
+    """Which source files each test module depends on, and whether its
+    tests passed, kept from one test run to the next.
+
+    A test module's dependencies are the modules that appear in
+    ``sys.modules`` while it is imported and while its module fixtures and
+    tests run, along with the modules its globals come from, and so on
+    from each of those modules in turn.  A test module whose tests all
+    passed last time
+    is cached if none of the source files it depends on have changed, as
+    told by their content hashes.
+
+    Results are only reused by runs of the same ``selection`` of tests.
+    """
+
+    format_version = 1
+
+    def __init__(self, path, selection):
+        self.path = path
+        self.selection = selection
+        self.cached_files = set()
+        self.cached_tests = 0
+        # source file: (mtime, size, digest); digests are only recomputed
+        # for files whose mtime or size changed
+        self._stats = {}
+        self._digests = {}
+        # test file: (passed, tests run, {source file: digest})
+        self._entries = {}
+        self._snapshots = []
+        # modules loaded before the first test module, which aren't
+        # followed any further
+        self._preloaded = None
+        self._loaded = {}
+        self._loaded_by = {}
+        self._references = {}
+        self._tests = {}
+        self._failed = set()
+        self._load()
+
+    def _load(self):
+        try:
+            cache_file = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                data = marshal.load(cache_file)
+            except (EOFError, ValueError, TypeError):
+                return
+        finally:
+            cache_file.close()
+        if (not isinstance(data, dict) or
+            data.get("version") != self.format_version):
+            return
+        self._stats = data["stats"]
+        if data["selection"] == self.selection:
+            self._entries = data["entries"]
+
+    def digest(self, path):
+        """Return the content hash of the file at ``path`` (None if it is
+        missing)."""
+        try:
+            return self._digests[path]
+        except KeyError:
+            pass
+        try:
+            stat = os.stat(path)
+        except OSError:
+            digest = None
+        else:
+            known = self._stats.get(path)
+            if known is not None and known[:2] == (stat.st_mtime,
+                                                   stat.st_size):
+                digest = known[2]
+            else:
+                source = open(path, "rb")
+                try:
+                    digest = hashlib.sha1(source.read()).hexdigest()
+                finally:
+                    source.close()
+                self._stats[path] = stat.st_mtime, stat.st_size, digest
+        self._digests[path] = digest
+        return digest
+
+    def is_cached(self, test_file):
+        """Return True if the tests in ``test_file`` need not be run."""
+        if test_file in self.cached_files:
+            return True
+        entry = self._entries.get(test_file)
+        if entry is None:
+            return False
+        passed, tests_run, digests = entry
+        if not (passed and tests_run):
+            return False
+        for path, digest in digests.iteritems():
+            if self.digest(path) != digest:
+                return False
+        self.cached_files.add(test_file)
+        self.cached_tests += tests_run
+        return True
+
+    def start_loading(self):
+        """Note the modules loaded before a test module is imported or its
+        module context is set up."""
+        before = set(sys.modules)
+        if self._preloaded is None:
+            self._preloaded = before
+        self._snapshots.append(before)
+
+    def stop_loading(self, test_file, module_name):
+        """Add the modules loaded since ``start_loading`` to the
+        dependencies of ``test_file``."""
+        before = self._snapshots.pop()
+        new = set(sys.modules) - before
+        for name in new:
+            self._loaded_by.setdefault(name, test_file)
+        loaded = self._loaded.setdefault(test_file, set())
+        loaded.update(new)
+        module = sys.modules.get(module_name)
+        if module is not None:
+            loaded.update(referenced_modules(module))
+
+    def start_test(self, test_file):
+        self._tests[test_file] = self._tests.get(test_file, 0) + 1
+
+    def test_failed(self, test_file):
+        self._failed.add(test_file)
+
+    def _referenced(self, name):
+        try:
+            return self._references[name]
+        except KeyError:
+            pass
+        module = sys.modules.get(name)
+        if module is None or name in self._preloaded:
+            names = ()
+        else:
+            names = referenced_modules(module)
+        self._references[name] = names
+        return names
+
+    def _dependencies(self, test_file):
+        # A module that another test module loaded first was loaded along
+        # with more modules, and may refer to modules loaded earlier still,
+        # so keep following both until nothing new turns up.
+        names = set()
+        pending = list(self._loaded.get(test_file, ()))
+        while pending:
+            name = pending.pop()
+            if name in names:
+                continue
+            names.add(name)
+            pending.extend(self._referenced(name))
+            other = self._loaded_by.get(name)
+            if other is not None and other != test_file:
+                pending.extend(self._loaded[other])
+        paths = set([test_file])
+        for name in names:
+            filename = getattr(sys.modules.get(name), "__file__", None)
+            if filename is not None:
+                paths.add(normalize_path(nose.util.src(filename)))
+        return paths
+
+    def save(self):
+        """Write the results of this run, keeping the entries of cached
+        test modules."""
+        for test_file, tests_run in self._tests.iteritems():
+            if test_file is None:
+                continue
+            digests = {}
+            for path in self._dependencies(test_file):
+                digests[path] = self.digest(path)
+            self._entries[test_file] = (test_file not in self._failed,
+                                        tests_run, digests)
+        for test_file in self._entries.keys():
+            if not os.path.exists(test_file):
+                del self._entries[test_file]
+        data = {"version": self.format_version,
+                "selection": self.selection,
+                "stats": self._stats,
+                "entries": self._entries}
+        temporary = self.path + ".new"
+        cache_file = open(temporary, "wb")
+        try:
+            marshal.dump(data, cache_file)
+        finally:
+            cache_file.close()
+        if os.path.exists(self.path):
+            # os.rename won't replace files on Windows
+            os.remove(self.path)
+        os.rename(temporary, self.path)
+
+
+class SafeRepr(reprlib.Repr):
+    """A repr() for showing values that may be huge, or slow to repr.
+
+    The result is cut short after ``max_length`` characters.  Once
+    ``max_seconds`` have been spent on a value, the items of containers
+    are no longer expanded (a single slow ``__repr__`` can't be stopped,
+    though).
+
+    >>> safe_repr = SafeRepr(max_length=40)
+    >>> print safe_repr.repr(range(1000))
+    [0, 1, 2, 3, 4, 5, ...]
+    >>> print safe_repr.repr("spam" * 100)
+    'spamspamspamspams...amspamspamspamspam'
+    >>> print safe_repr.repr(dict((n, "x" * 30) for n in range(3)))
+    {0: 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx', 1...<72 more characters>
+    >>> class Broken(object):
+    ...     def __repr__(self):
+    ...         raise ValueError("oops")
+    >>> print safe_repr.repr(Broken())
+    <Broken.__repr__ raised ValueError>
+    """
+
+    def __init__(self, max_length=200, max_seconds=0.1):
+        reprlib.Repr.__init__(self)
+        self.maxstring = self.maxother = self.maxlong = max_length
+        self.max_length = max_length
+        self.max_seconds = max_seconds
+        self._deadline = None
+
+    def repr(self, x):
+        self._deadline = time.time() + self.max_seconds
+        text = self.repr1(x, self.maxlevel)
+        if len(text) > self.max_length:
+            text = "%s...<%d more characters>" % (
+                text[:self.max_length - 1], len(text) - self.max_length + 1)
+        return text.replace("\n", "\\n")
+
+    def repr1(self, x, level):
+        if time.time() > self._deadline:
+            return "...<out of time>"
+        try:
+            return reprlib.Repr.repr1(self, x, level)
+        except Exception, exc:
+            return "<%s.__repr__ raised %s>" % (type(x).__name__,
+                                                 exc.__class__.__name__)
+
+
+def format_locals(frame, safe_repr):
+    """Return "name = value" lines for the local variables of ``frame``.
+
+    Module-level frames are left out: their locals are the module globals.
+    """
+    if frame.f_locals is frame.f_globals:
+        return []
+    return ["        %s = %s\n" % (name, safe_repr.repr(value))
+            for name, value in sorted(frame.f_locals.items())]
+
+
+def format_exception_with_locals(exctype, value, tb, limit, frames,
+                                 safe_repr):
+    """Like ``traceback.format_exception``, but the source line of each of
+    the innermost ``frames`` frames is followed by the local variables of
+    the frame (see ``format_locals``).
+    """
+    entries = []
+    while tb is not None and (limit is None or len(entries) < limit):
+        entries.append((tb.tb_frame, traceback.extract_tb(tb, 1)[0]))
+        tb = tb.tb_next
+    lines = []
+    if entries:
+        lines.append("Traceback (most recent call last):\n")
+    for index, (frame, entry) in enumerate(entries):
+        lines.extend(traceback.format_list([entry]))
+        if index >= len(entries) - frames:
+            lines.extend(format_locals(frame, safe_repr))
+    lines.extend(traceback.format_exception_only(exctype, value))
+    return "".join(lines)
+
+
+def parse_shard(text):
+    """Parse a shard specification like "3/12" into (3, 12).
+
+    >>> parse_shard("3/12")
+    (3, 12)
+    >>> parse_shard("13/12")
+    Traceback (most recent call last):
+    ...
+    ValueError: bad shard '13/12': expected I/N, with 1 <= I <= N
+    """
+    try:
+        index, count = map(int, text.split("/"))
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        raise ValueError("bad shard %r: expected I/N, with 1 <= I <= N" %
+                         text)
+    return index, count
+
+
+def assign_shards(durations, count):
+    """Share out test files between ``count`` shards, balancing the time
+    each shard takes.
+
+    ``durations`` maps test files to the seconds their tests took.  The
+    longest file goes first, each to the shard with the least work so far,
+    so that every machine computes the same assignment.  Returns a mapping
+    of files to shard indices (from 0).
+
+    >>> assignment = assign_shards({"a.py": 5, "b.py": 4, "c.py": 3,
+    ...                             "d.py": 3, "e.py": 1}, 2)
+    >>> sorted(assignment.items())
+    [('a.py', 0), ('b.py', 1), ('c.py', 1), ('d.py', 0), ('e.py', 1)]
+    """
+    loads = [(0, index) for index in range(count)]
+    assignment = {}
+    for minus_duration, path in sorted([(-duration, path) for path, duration
+                                        in durations.iteritems()]):
+        load, index = heapq.heappop(loads)
+        assignment[path] = index
+        heapq.heappush(loads, (load - minus_duration, index))
+    return assignment
+
+
+class Shard(object):
+    """One of ``count`` shards of a test run, which runs the tests from
+    some of the test files.
+
+    Files are known by their paths relative to ``base_dir``.  Those with a
+    recorded duration are assigned by ``assign_shards``; the others by a
+    checksum of their path.  Tests not loaded from a file run in the first
+    shard.
+    """
+
+    def __init__(self, index, count, durations, base_dir):
+        self.index = index
+        self.count = count
+        self._base_dir = base_dir
+        self._assignment = assign_shards(durations, count)
+        self._owns = {}
+
+    def owns(self, path):
+        """Return True if the tests from ``path`` belong to this shard."""
+        try:
+            return self._owns[path]
+        except KeyError:
+            pass
+        if path is None:
+            shard = 0
+        else:
+            key = relative_location(self._base_dir, path)
+            shard = self._assignment.get(key)
+            if shard is None:
+                shard = (binascii.crc32(key) & 0xffffffff) % self.count
+        owns = self._owns[path] = shard == self.index
+        return owns
+
+
+def read_durations(durations_file):
+    """Read a file of test durations, as written by ``write_durations``.
+
+    >>> from cStringIO import StringIO
+    >>> read_durations(StringIO("# comment\\n1.5\\ttests/test_a.py\\n"))
+    {'tests/test_a.py': 1.5}
+    """
+    durations = {}
+    for line in durations_file:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            seconds, path = line.split("\t", 1)
+            durations[path] = float(seconds)
+    return durations
+
+
+def write_durations(durations_file, durations):
+    durations_file.write("# seconds\ttest file, relative to the directory "
+                         "the tests were run from\n")
+    for path, seconds in sorted(durations.iteritems()):
+        durations_file.write("%.6f\t%s\n" % (seconds, path))
 
 
 # colour output code taken from zope.testing, and hacked
@@ -399,7 +1817,8 @@ Got:
                   "!": "actual-output",}
 
     def __init__(self, verbosity, descriptions, colorscheme,
-                 stream=sys.stdout, clean_tracebacks=False, base_dir=False):
+                 stream=sys.stdout, clean_tracebacks=False, base_dir=False,
+                 compress_ids=False, reset_after_test=False):
         self._stream = stream
         self._verbose = bool(verbosity)
         self._show_all = verbosity > 1
@@ -407,7 +1826,23 @@ Got:
         self._descriptions = descriptions
         self._clean_tracebacks = clean_tracebacks
         self._base_dir = base_dir
+        self._compress_ids = compress_ids
+        # whether the colour goes back to normal after every test, rather
+        # than when something other than a dot is written next
+        self._reset_after_test = reset_after_test
+        self._group = None
+        # whether start_test writes "name ... " ahead of the outcome (see
+        # ThreadSafeFormatter)
+        self._partial_lines = True
+        self._described_test = None
+        self._description = None
         self._colorscheme = colorscheme
+        # Colours requested since the last text was written, and the
+        # (bold, foreground) state we believe the terminal to be in.  Escape
+        # sequences are only written when the state actually has to change.
+        self._pending_colors = []
+        self._terminal_state = (False, None)
+        self._transitions = {}
 #         for name, value in self._colorscheme.items():
 #             print >>sys.stderr, '%s = %s' % (name, value)
 
@@ -419,112 +1854,287 @@ Got:
         """Wrap message in color."""
         return self.color(what) + message + self.color(normal)
 
+    def set_color(self, what):
+        """Switch to a named color for the text written next."""
+        self._pending_colors.append(self._colorscheme[what])
+
+    def write(self, text, what=None):
+        """Write text, wrapped in a named color if ``what`` is given."""
+        if what is not None:
+            self._pending_colors.append(self._colorscheme[what])
+        if text:
+            if self._pending_colors:
+                self._settle_color()
+            self._stream.write(text)
+        if what is not None:
+            self._pending_colors.append(self._colorscheme["normal"])
+
+    def writeln(self, text="", what=None):
+        self.write(text, what)
+        self.write("\n")
+
+    def write_parts(self, parts):
+        """Write a sequence of (color name, text) pairs.
+
+        Each piece of text is written in its color, which stays in effect
+        until the next one is selected.
+        """
+        for what, text in parts:
+            self.set_color(what)
+            self.write(text)
+
+    def _settle_color(self):
+        """Emit the escape sequences needed to bring the terminal into the
+        state the pending colors would have left it in."""
+        colors = self._pending_colors
+        if not colors:
+            return
+        self._pending_colors = []
+        key = self._terminal_state, tuple(colors)
+        try:
+            codes, target = self._transitions[key]
+        except KeyError:
+            codes, target = self._transitions[key] = self._transition(*key)
+        if codes:
+            self._stream.write(codes)
+        self._terminal_state = target
+
+    def _transition(self, state, colors):
+        target = state
+        for color in colors:
+            target = color.apply_to(target)
+        if target == state:
+            return "", state
+        if colors[-1].apply_to(state) == target:
+            colors = colors[-1:]
+        codes = []
+        for color in colors:
+            code = color.terminal_code()
+            if not codes or codes[-1] != code:
+                codes.append(code)
+        return "".join(codes), target
+
+    def reset(self, stream=None):
+        """Return the terminal to the normal colour.
+
+        If ``stream`` is given, further output is written to it.
+        """
+        self.redirect(stream)
+        self._group = None
+
+    def redirect(self, stream=None):
+        """Return the terminal to the normal colour, then write further
+        output to ``stream``, if given."""
+        self.set_color("normal")
+        self._settle_color()
+        if stream is not None:
+            self._stream = stream
+
     def get_description(self, test):
-        if self._descriptions:
-            return test.shortDescription() or str(test)
-        else:
-            return str(test)
+        # Asked for several times while each test runs (for the progress
+        # output, the log, failure records...), and str(test) can be slow.
+        if test is not self._described_test:
+            if self._descriptions:
+                self._description = test.shortDescription() or str(test)
+            else:
+                self._description = str(test)
+            self._described_test = test
+        return self._description
 
     def start_test(self, test):
         if self._show_all:
-            self._stream.write(self.colorize("normal",
-                                             self.get_description(test)))
-            self._stream.write(self.colorize("normal", " ... "))
+            description = self.get_description(test)
+            if self._compress_ids:
+                description = self._start_group(description)
+            self.write(description, "normal")
+            self.write(" ... ", "normal")
         self._stream.flush()
 
+    def _start_group(self, description):
+        # Write the module or class name once for a run of tests from it,
+        # and return the test's description without it.
+        split = split_description(description)
+        if split is None:
+            self._group = None
+            return description
+        group, item = split
+        if group != self._group:
+            self.writeln(group, "testname")
+            self._group = group
+        return "    " + item
+
     def test_success(self, test):
         if self._show_all:
-            self._stream.writeln(self.colorize("pass", "ok"))
+            self.writeln("ok", "pass")
         elif self._dots:
-            self._stream.write(self.colorize("pass", "."))
+            self.write(".", "pass")
 
     def test_error(self, test, exc_info, label):
         if self._show_all:
-            self._stream.writeln(self.colorize("error", label))
+            self.writeln(label, "error")
         elif self._dots:
-            self._stream.write(self.colorize("error", label[:1]))
+            self.write(label[:1], "error")
 
     def test_skip(self, label):
         if self._show_all:
-            self._stream.writeln(self.colorize("skip", label))
+            self.writeln(label, "skip")
         elif self._dots:
-            self._stream.write(self.colorize("skip", label[:1]))
+            self.write(label[:1], "skip")
 
     def test_failure(self, test, exc_info):
         if self._show_all:
-            self._stream.writeln(self.colorize("failure", "FAIL"))
+            self.writeln("FAIL", "failure")
         elif self._dots:
-            self._stream.write(self.colorize("failure", "F"))
+            self.write("F", "failure")
 
     def print_error_list(self, flavour, errors):
         problem_color = {
             "FAIL": "failure",
-            "SKIP": "skip"
+            "SKIP": "skip",
+            "FLAKY": "flaky",
         }.get(flavour, "error")
+        group = None
         for tup in errors:
             test, err = tup[:2]
             try:
                 err_type = tup[2]
             except IndexError:
                 err_type = None
+            try:
+                details = tup[3]
+            except IndexError:
+                details = None
+            self.writeln(self.separator1)
+            self.write(flavour, problem_color)
+            self.write(": ")
+            description = self.get_description(test)
+            if self._compress_ids:
+                split = split_description(description)
+                if split is None:
+                    group = None
+                elif split[0] == group:
+                    # same module or class as the one above
+                    description = "..." + split[1]
+                else:
+                    group = split[0]
+            self.write(description, "testname")
             # Handle skip message
-            skip_msg = ""
             if flavour == "SKIP":
-                reason = getattr(err, "message", None)
+                if isinstance(err, basestring):
+                    # read back from disk or a log
+                    reason = err
+                else:
+                    reason = getattr(err, "message", None)
                 if reason:
-                    skip_msg = " (%s)" % self.colorize("skip", reason)
-            self._stream.writeln(self.separator1)
-            self._stream.writeln("%s: %s%s" % (
-                    self.colorize(problem_color, flavour),
-                    self.colorize("testname", self.get_description(test)),
-                    skip_msg
-            ))
+                    self.write(" (")
+                    self.write(reason, "skip")
+                    self.write(")")
+            self.writeln()
             if flavour != "SKIP":
-                self._stream.writeln(self.separator2)
-                self.print_traceback(err, err_type)
+                self.writeln(self.separator2)
+                self.print_traceback(err, err_type, details)
+
+    def print_errors(self, errors, failures, error_classes):
+        """Report all the problems found in a test run.
+
+        ``error_classes`` is a sequence of (storage, label, isfail) tuples,
+        like the values of nose's ``result.errorClasses``.
+        """
+        if self._dots or self._show_all:
+            self.writeln()
+        self.print_error_list("ERROR", errors)
+        self.print_error_list("FAIL", failures)
+        for storage, label, isfail in error_classes:
+            self.print_error_list(label, storage)
+
+    def print_memory_report(self, columns, total, tests, modules,
+                            tests_sampled, tests_seen):
+        """Print the tests and modules that grew memory use the most.
+
+        ``columns`` names the kinds of memory measured, and ``total`` holds
+        the growth over the whole run, one number per column.  ``tests`` and
+        ``modules`` are sequences of (growth, name) pairs.
+        """
+        self.writeln(self.separator2)
+        self.write("Memory growth (")
+        for index, column in enumerate(columns):
+            if index:
+                self.write(", ")
+            self.write("%s " % column)
+            self.write(format_bytes(total[index]), "number")
+        self.write(") in ")
+        self.write(str(tests_sampled), "number")
+        self.write(" of ")
+        self.write(str(tests_seen), "number")
+        self.writeln(" tests sampled")
+        for title, rows in [("test", tests), ("module", modules)]:
+            self.writeln("".join(["%10s" % column for column in columns]) +
+                         "  " + title)
+            for growth, name in rows:
+                self.write("".join(["%10s" % format_bytes(value)
+                                    for value in growth]), "number")
+                self.write("  ")
+                self.writeln(name, "testname")
 
     def print_summary(self, success, summary, tests_run, start, stop):
-        write = self._stream.write
-        writeln = self._stream.writeln
-        writelines = self._stream.writelines
         taken = float(stop - start)
         plural = tests_run != 1 and "s" or ""
         count_color = success and "ok-number" or "error-number"
 
-        writeln(self.separator2)
-        writelines([
-                "Ran ",
-                self.colorize(count_color, "%s " % tests_run),
-                "test%s in " % plural,
-                self._format_seconds(taken)])
-        writeln()
-        if not success:
-            write(self.colorize("failure", "FAILED"))
-            write(" (")
-            any = False
-            for label, count in summary.items():
-                if not count:
-                    continue
-                if any:
-                    write(", ")
-                write("%s=" % label)
-                problem_color = (label == "failures") and "failure" or "error"
-                write(self.colorize(problem_color, str(count)))
-                any = True
-            writeln(")")
+        self.writeln(self.separator2)
+        self.write("Ran ")
+        self.write("%s " % tests_run, count_color)
+        self.write("test%s in " % plural)
+        self.write_parts(self._format_seconds(taken))
+        self.writeln()
+        if success:
+            self.write("OK", "pass")
         else:
-            writeln(self.colorize("pass", "OK"))
-
-    def _format_seconds(self, n_seconds, normal="normal"):
-        """Format a time in seconds."""
+            self.write("FAILED", "failure")
+        counts = [(label, count) for label, count in summary.items() if count]
+        if counts:
+            self.write(" (")
+            for index, (label, count) in enumerate(counts):
+                if index:
+                    self.write(", ")
+                self.write("%s=" % label)
+                problem_color = {"failures": "failure",
+                                 "flaky": "flaky",
+                                 "cached": "cached"}.get(label, "error")
+                self.write(str(count), problem_color)
+            self.write(")")
+        self.writeln()
+
+    def print_rerun_header(self, count, times):
+        """Announce that ``count`` failed tests will be run again."""
+        if self._dots or self._show_all:
+            self.writeln()
+        self.writeln(self.separator2)
+        self.write("Running ")
+        self.write(str(count), "number")
+        self.write(" failed test%s again, " % (count != 1 and "s" or ""))
+        self.write(str(times), "number")
+        self.writeln(" time%s at most:" % (times != 1 and "s" or ""))
+
+    def print_rerun(self, description, label):
+        """Report whether a failed test passed when run again: ``label`` is
+        FLAKY if it did."""
+        self.write(description, "testname")
+        self.write(" ... ")
+        self.writeln(label, {"FLAKY": "flaky",
+                             "FAIL": "failure"}.get(label, "error"))
+
+    def _format_seconds(self, n_seconds):
+        """Format a time in seconds, as a list of (color name, text) pairs."""
         if n_seconds >= 60:
             n_minutes, n_seconds = divmod(n_seconds, 60)
-            return "%s minutes %s seconds" % (
-                        self.colorize("number", "%d" % n_minutes, normal),
-                        self.colorize("number", "%.3f" % n_seconds, normal))
+            return [("number", "%d" % n_minutes),
+                    ("normal", " minutes "),
+                    ("number", "%.3f" % n_seconds),
+                    ("normal", " seconds")]
         else:
-            return "%s seconds" % (
-                        self.colorize("number", "%.3f" % n_seconds, normal))
+            return [("number", "%.3f" % n_seconds),
+                    ("normal", " seconds")]
 
     def format_traceback(self, exc_info):
         """Format the traceback."""
@@ -550,13 +2160,85 @@ Got:
             tb = "".join(traceback.format_exception(*exc_info))
         return tb
 
-    def print_traceback(self, formatted_traceback, err_type):
-        """Report an error with a traceback."""
-        if issubclass(err_type, DocTestFailureException):
+    def print_traceback(self, formatted_traceback, err_type, details=None):
+        """Report an error with a traceback.
+
+        ``details`` is the list of failed examples recorded for a doctest
+        failure, if any.
+        """
+        if details is not None:
+            self.print_doctest_failures(formatted_traceback, details)
+        elif issubclass(err_type, DocTestFailureException):
             self.print_doctest_failure(formatted_traceback)
         else:
             self.print_colorized_traceback(formatted_traceback)
-            print >>self._stream
+            self.writeln()
+
+    def print_doctest_failures(self, formatted_traceback, failures):
+        """Report a doctest failure from a record of the failed examples.
+
+        ``formatted_traceback`` is the traceback of the failure, ending with
+        the heading that names the doctest, and ``failures`` is a list of
+        failed examples as recorded by RecordingDocTestRunner.
+        """
+        self.print_colorized_traceback(formatted_traceback.rstrip("\n"))
+        self.writeln()
+        for (filename, lineno, name, source, want, got, exception,
+             diff_kind, diff_lines) in failures:
+            self.writeln(self.separator2)
+            if filename is not None:
+                lineno = str(lineno)
+                if self._clean_tracebacks:
+                    filename, lineno = elide_foreign_path_and_line_nr(
+                        self._base_dir, filename, lineno)
+                self.write_parts([
+                    ("normal", 'File "'),
+                    ("filename", filename),
+                    ("normal", '", line '),
+                    ("lineno", lineno),
+                    ("normal", ", in "),
+                    ("testname", name),
+                    ("normal", "\n")])
+            else:
+                self.writeln("Line %s, in %s" % (lineno, name))
+            self.writeln("Failed example:")
+            self._write_indented(source, "failed-example")
+            if exception is not None:
+                self.writeln("Exception raised:")
+                self.print_colorized_traceback(exception, indent_level=1)
+            elif diff_kind is not None:
+                if diff_kind.endswith(" with -expected +actual"):
+                    self.write_parts([
+                        ("normal", "Differences (%s with " %
+                         diff_kind.split(" with ")[0]),
+                        ("expected-output", "-expected "),
+                        ("actual-output", "+actual"),
+                        ("normal", "):\n")])
+                else:
+                    self.writeln("Differences (%s):" % diff_kind)
+                for line in diff_lines:
+                    color = line and self.diff_color.get(line[0]) or "normal"
+                    self.writeln("    " + line, color)
+            else:
+                if want:
+                    self.writeln("Expected:")
+                    self._write_indented(want, "expected-output")
+                else:
+                    self.writeln("Expected nothing")
+                if got:
+                    self.writeln("Got:")
+                    self._write_indented(got, "actual-output")
+                else:
+                    self.writeln("Got nothing")
+        self.writeln()
+        self.writeln()
+
+    def _write_indented(self, text, what):
+        for line in text.splitlines():
+            if line:
+                self.writeln("    " + line, what)
+            else:
+                self.writeln()
 
     def print_doctest_failure(self, formatted_failure):
         """Report a doctest failure.
@@ -579,8 +2261,8 @@ Got:
                 break
             exc_lines.append(line)
         self.print_colorized_traceback("\n".join(exc_lines))
-        print >>self._stream
-        print >>self._stream, self.separator2
+        self.writeln()
+        self.writeln(self.separator2)
         exc_lines = []
 
         for line in lines:
@@ -591,26 +2273,25 @@ Got:
                     if self._clean_tracebacks:
                         filename, lineno = elide_foreign_path_and_line_nr(
                             self._base_dir, filename, lineno)
-                    self._stream.writelines([
-                        self.color('normal'), 'File "',
-                        self.color('filename'), filename,
-                        self.color('normal'), '", line ',
-                        self.color('lineno'), lineno,
-                        self.color('normal'), ', in ',
-                        self.color('testname'), test,
-                        self.color('normal'), '\n'])
+                    self.write_parts([
+                        ('normal', 'File "'),
+                        ('filename', filename),
+                        ('normal', '", line '),
+                        ('lineno', lineno),
+                        ('normal', ', in '),
+                        ('testname', test),
+                        ('normal', '\n')])
                 else:
-                    print >>self._stream, line
+                    self.writeln(line)
             elif line.startswith('    '):
                 if colorize_diff and len(line) > 4:
                     color = self.diff_color.get(line[4],
                                                 color_of_indented_text)
-                    print >>self._stream, self.colorize(color, line)
+                    self.writeln(line, color)
                 elif colorize_exception:
                     exc_lines.append(line[4:])
                 else:
-                    print >>self._stream, self.colorize(color_of_indented_text,
-                                                        line)
+                    self.writeln(line, color_of_indented_text)
             else:
                 colorize_diff = False
                 if colorize_exception:
@@ -632,18 +2313,24 @@ Got:
                         "Differences (ndiff with -expected +actual):",
                         "Differences (unified diff with -expected +actual):"
                         ]:
-                        line = "".join([
-                                "Differences (ndiff with ",
-                                self.color("expected-output"), "-expected ",
-                                self.color("actual-output"), "+actual",
-                                self.color("normal"), "):",
+                        self.write_parts([
+                                ("normal", "Differences (ndiff with "),
+                                ("expected-output", "-expected "),
+                                ("actual-output", "+actual"),
+                                ("normal", "):\n"),
                                 ])
+                        line = None
                     color_of_indented_text = 'normal'
                     colorize_diff = True
                 else:
                     color_of_indented_text = 'normal'
-                print >>self._stream, line
-        print >>self._stream
+                if line is not None:
+                    self.writeln(line)
+        self.writeln()
+
+    # Source lines in tracebacks are stripped, so only the lines added by
+    # format_locals start with more than four spaces.
+    _local_regexp = re.compile(r"        ([A-Za-z_]\w*) = (.*)$")
 
     def print_colorized_traceback(self, formatted_traceback, indent_level=0):
         """Report a test failure.
@@ -659,46 +2346,284 @@ Got:
                     if self._clean_tracebacks:
                         filename, lineno = elide_foreign_path_and_line_nr(
                             self._base_dir, filename, lineno)
-                    tb_lines = [
-                        self.color("normal"), '  File "',
-                        self.color("filename"), filename,
-                        self.color("normal"), '", line ',
-                        self.color("lineno"), lineno,
+                    tb_parts = [
+                        ("normal", '  File "'),
+                        ("filename", filename),
+                        ("normal", '", line '),
+                        ("lineno", lineno),
                         ]
                     if test:
                         # this is missing for the first traceback in doctest
                         # failure report
-                        tb_lines.extend([
-                                self.color("normal"), ", in ",
-                                self.color("testname"), test,
+                        tb_parts.extend([
+                                ("normal", ", in "),
+                                ("testname", test),
                                 ])
-                    tb_lines.extend([
-                            self.color("normal"), "\n",
-                                    ])
-                    self._stream.write(indentation)
-                    self._stream.writelines(tb_lines)
+                    tb_parts.append(("normal", "\n"))
+                    self.write(indentation)
+                    self.write_parts(tb_parts)
                 else:
-                    print >>self._stream, indentation + line
+                    self.writeln(indentation + line)
+            elif line.startswith("        ") and self._local_regexp.match(line):
+                # a local variable, from --color-locals
+                name, value = self._local_regexp.match(line).groups()
+                self.write(indentation + "        ")
+                self.write(name, "local-name")
+                self.write(" = ")
+                self.writeln(value, "local-value")
             elif line.startswith("    "):
-                print >>self._stream, self.colorize("failed-example",
-                                                    indentation + line)
+                self.writeln(indentation + line, "failed-example")
             elif line.startswith("Traceback (most recent call last)"):
-                print >>self._stream, indentation + line
+                self.writeln(indentation + line)
             else:
-                print >>self._stream, self.colorize("exception",
-                                                    indentation + line)
+                self.writeln(indentation + line, "exception")
+
+    phase_labels = {"collection": "collection",
+                    "import": "imports",
+                    "setup": "fixture setup",
+                    "test": "tests",
+                    "teardown": "fixture teardown",
+                    "report": "reporting"}
+
+    def print_phase_report(self, phases, total, fixtures):
+        """Print how long each phase of the test run took.
+
+        ``phases`` is a sequence of (phase, seconds) pairs, and ``fixtures``
+        a sequence of (total, setup, teardown, context name) tuples.
+        """
+        self.writeln(self.separator2)
+        self.write("Time by phase (")
+        self.write_parts(self._format_seconds(total))
+        self.writeln(" in total):")
+        for phase, seconds in phases:
+            self.write("%18s  " % self.phase_labels.get(phase, phase))
+            self.write_parts(self._format_seconds(seconds))
+            percent = total and 100 * seconds / total or 0
+            self.writeln(" (%.1f%%)" % percent)
+        if not fixtures:
+            return
+        self.writeln("Most expensive fixtures (setup + teardown):")
+        for total, setup, teardown, name in fixtures:
+            self.write("    ")
+            self.write_parts(self._format_seconds(setup))
+            self.write(" + ")
+            self.write_parts(self._format_seconds(teardown))
+            self.write("  ")
+            self.writeln(name, "testname")
+
+    def print_shard_report(self, shards):
+        """Print how long each shard of a sharded test run took.
+
+        ``shards`` is a sequence of (shard name, tests run, seconds) tuples.
+        The slowest shard is the critical path: the run took that long.
+        """
+        self.writeln(self.separator2)
+        self.write("Time by shard (")
+        self.write_parts(self._format_seconds(
+            sum([seconds for name, tests_run, seconds in shards])))
+        self.writeln(" of machine time):")
+        slowest = max([seconds for name, tests_run, seconds in shards])
+        for name, tests_run, seconds in shards:
+            self.write("%18s  " % name)
+            self.write("%6d" % tests_run, "number")
+            self.write(" test%s  " % (tests_run != 1 and "s" or " "))
+            self.write_parts(self._format_seconds(seconds))
+            if seconds == slowest:
+                self.write(" (critical path)", "error")
+                slowest = None
+            self.writeln()
+
+    def print_timing_regressions(self, regressions, history):
+        """Print the tests that took much longer than usual.
+
+        ``regressions`` is a sequence of (seconds, usual seconds, test id)
+        tuples, the usual time being the median over the last ``history``
+        runs.
+        """
+        self.writeln(self.separator2)
+        self.writeln("Slower than the median of the last %d runs:" % history)
+        for seconds, usual, name in regressions:
+            self.write("    ")
+            self.write_parts(self._format_seconds(seconds))
+            if usual:
+                self.write(" (x%.1f)" % (seconds / usual), "error")
+            self.write(", usually ")
+            self.write_parts(self._format_seconds(usual))
+            self.write("  ")
+            self.writeln(name, "testname")
+
+    def print_hang_notice(self, test, elapsed, stacks):
+        """Report a test that is still running after ``elapsed`` seconds.
+
+        ``stacks`` is a sequence of (thread name, formatted stack) pairs.
+        """
+        if self._dots or self._show_all:
+            self.writeln()
+        self.write("Still running", "error")
+        self.write(" after ")
+        self.write_parts(self._format_seconds(elapsed))
+        self.write(": ")
+        self.writeln(self.get_description(test), "testname")
+        for name, stack in stacks:
+            self.writeln("Thread %s:" % name)
+            self.print_colorized_traceback(stack)
+        if self._show_all and self._partial_lines:
+            self.start_test(test)
+        self._settle_color()
+        self._stream.flush()
+
+    def print_thread_report(self, threads):
+        """Print how many tests each thread ran, and how fast.
+
+        ``threads`` is a sequence of (thread name, tests run, seconds spent
+        running them) tuples.
+        """
+        self.writeln(self.separator2)
+        self.writeln("Tests by thread:")
+        for name, tests_run, seconds in threads:
+            self.write("%18s  " % name)
+            self.write("%6d" % tests_run, "number")
+            self.write(" test%s  " % (tests_run != 1 and "s" or " "))
+            self.write_parts(self._format_seconds(seconds))
+            if seconds:
+                self.write(" (%.1f tests/second)" % (tests_run / seconds))
+            self.writeln()
 
     def stop_test(self, test):
         if self._verbose > 1:
-            print >>self._stream
+            self.writeln()
+        if self._reset_after_test:
+            # for tests that write to the terminal themselves
+            self._settle_color()
         self._stream.flush()
 
     def stop_tests(self):
         if self._verbose == 1:
-            self._stream.write("\n")
+            self.write("\n")
+        self._settle_color()
         self._stream.flush()
 
 
+class OutputChunk(list):
+    """Stream that collects what is written to it."""
+
+    write = list.append
+
+    def flush(self):
+        pass
+
+
+class ThreadSafeFormatter(object):
+    """Wraps a ColorfulOutputFormatter for tests that run in several
+    threads at once.
+
+    Each call to the formatter is rendered into a chunk of output, ending
+    in the normal colour, which is written to the stream in one go while
+    holding a lock.  In verbose mode, a test's "name ... outcome" line is
+    only written, whole, once its outcome is known, so that tests running
+    at the same time don't split each other's lines.  The number of tests
+    each thread ran and the time they took are kept for
+    ``print_thread_report``.  The plugin keeps its own books under the same
+    ``lock``.
+    """
+
+    def __init__(self, formatter, stream):
+        self._formatter = formatter
+        self._formatter._partial_lines = False
+        self._stream = stream
+        self.lock = threading.RLock()
+        # id(test): (thread name, start time)
+        self._in_flight = {}
+        # thread ident: the test running in it, for outcomes reported
+        # without the test
+        self._running = {}
+        # thread name: [tests run, seconds]
+        self._threads = {}
+
+    def _chunk(self, method, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            chunk = OutputChunk()
+            self._formatter.redirect(chunk)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._formatter.redirect(self._stream)
+                if chunk:
+                    self._stream.write("".join(chunk))
+                    self._stream.flush()
+        finally:
+            self.lock.release()
+
+    def __getattr__(self, name):
+        method = getattr(self._formatter, name)
+        def chunked(*args, **kwargs):
+            return self._chunk(method, *args, **kwargs)
+        return chunked
+
+    def reset(self, stream=None):
+        self.lock.acquire()
+        try:
+            if stream is not None:
+                self._stream = stream
+            self._formatter.reset(stream)
+        finally:
+            self.lock.release()
+
+    def get_description(self, test):
+        self.lock.acquire()
+        try:
+            return self._formatter.get_description(test)
+        finally:
+            self.lock.release()
+
+    def start_test(self, test):
+        thread = threading.currentThread()
+        self._in_flight[id(test)] = thread.getName(), time.time()
+        self._running[thread.ident] = test
+
+    def _outcome(self, test, method, *args):
+        if self._formatter._show_all:
+            self._formatter.start_test(test)
+        method(*args)
+
+    def test_success(self, test):
+        self._chunk(self._outcome, test, self._formatter.test_success, test)
+
+    def test_failure(self, test, exc_info):
+        self._chunk(self._outcome, test, self._formatter.test_failure, test,
+                    exc_info)
+
+    def test_error(self, test, exc_info, label):
+        self._chunk(self._outcome, test, self._formatter.test_error, test,
+                    exc_info, label)
+
+    def test_skip(self, label):
+        test = self._running.get(threading.currentThread().ident)
+        self._chunk(self._outcome, test, self._formatter.test_skip, label)
+
+    def stop_test(self, test):
+        stop = time.time()
+        self._running.pop(threading.currentThread().ident, None)
+        try:
+            name, start = self._in_flight.pop(id(test))
+        except KeyError:
+            return
+        self.lock.acquire()
+        try:
+            counts = self._threads.setdefault(name, [0, 0])
+            counts[0] += 1
+            counts[1] += stop - start
+        finally:
+            self.lock.release()
+
+    def print_thread_report(self):
+        threads = [(name, tests_run, seconds) for name, (tests_run, seconds)
+                   in sorted(self._threads.items())]
+        self._threads = {}
+        self._chunk(self._formatter.print_thread_report, threads)
+
+
 class ColorOutputPlugin(nose.plugins.Plugin):
 
     """Output test results in colour to terminal."""
@@ -708,6 +2633,21 @@ class ColorOutputPlugin(nose.plugins.Plugin):
     formatter_class = ColorfulOutputFormatter
     clean_tracebacks = False
     base_dir = None
+    # number of tests and modules listed by --color-memory
+    memory_report_size = 10
+    # number of fixtures listed by --color-phases
+    fixture_report_size = 10
+    # seconds spent on the repr of each local variable by --color-locals
+    locals_time_budget = 0.1
+    # --color-timings compares each test with the median of its last
+    # timing_history runs, if it ran at least timing_min_samples times,
+    # and ignores slowdowns of less than timing_min_seconds
+    timing_history = 20
+    timing_min_samples = 3
+    timing_min_seconds = 0.01
+    timing_report_size = 10
+    # number of runs a test may miss before --color-timings forgets it
+    timing_keep_runs = 100
 
     # These colors are carefully chosen to have enough contrast
     # on terminals with both black and white background.
@@ -727,7 +2667,11 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                            "character-diffs": "magenta",
                            "diff-chunk": "magenta",
                            "exception": "red",
-                           "skip": "yellow"}
+                           "skip": "yellow",
+                           "flaky": "yellow",
+                           "cached": "green",
+                           "local-name": "lightyellow",
+                           "local-value": "normal"}
     default_colorscheme = dict((name, parse_color(color)) for name, color in
                                default_colorscheme.iteritems())
 
@@ -740,6 +2684,41 @@ class ColorOutputPlugin(nose.plugins.Plugin):
     def __init__(self):
         nose.plugins.Plugin.__init__(self)
         self._result = None
+        self._formatter = None
+        self._parsed_colors = None
+        # set by Watcher, which needs to know which tests to run again
+        self.track_tests = False
+        self.failed_tests = []
+        self.test_files = set()
+        self.watch_interval = 1.0
+        self._record_path = None
+        self._recorder = None
+        self._memory = False
+        self._memory_tracker = None
+        self._hang_timeout = 0
+        self._watchdog = None
+        self._phases = False
+        self._phase_timer = None
+        self._failure_budget = 0
+        self._failure_stores = []
+        self._shard = None
+        self._locals_frames = 0
+        self._safe_repr = None
+        self._compress_ids = False
+        self._reset_after_test = False
+        self._threadsafe = False
+        self._cache_path = None
+        self._dependency_cache = None
+        self._timings_path = None
+        self._timing_db = None
+        self._test_durations = {}
+        # test: when it started, for --color-timings
+        self._test_starts = {}
+        self._rerun_times = 0
+        self._rerun_failures = []
+        self._rerun_errors = []
+        self._file_durations = {}
+        self._relative_paths = {}
         # for debugging
 #         self.base_dir = os.path.dirname(__file__)
 #     clean_tracebacks = True
@@ -774,6 +2753,193 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                                "colour 'normal'.  Example: "
                                "--colors='fail=red,pass=rgb(00ff00),error=45' "
                                + "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_RECORD"
+        parser.add_option("--color-record", action="store",
+                          type="string",
+                          dest="color_record",
+                          default=env.get(env_opt),
+                          metavar="FILE",
+                          help="Append the events of the test run to FILE, "
+                               "so that the output can be rendered again "
+                               "with 'rudolf replay' [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_WATCH_INTERVAL"
+        parser.add_option("--color-watch-interval", action="store",
+                          type="float",
+                          dest="color_watch_interval",
+                          default=env.get(env_opt, 1.0),
+                          help="Seconds between checks for changed files "
+                               "when running under 'rudolf watch' "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_MEMORY"
+        parser.add_option("--color-memory", action="store_true",
+                          dest="color_memory",
+                          default=bool(env.get(env_opt)),
+                          help="Measure how much memory each test leaves "
+                               "behind, and report the tests and modules "
+                               "that grew the most [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_MEMORY_INTERVAL"
+        parser.add_option("--color-memory-interval", action="store",
+                          type="int",
+                          dest="color_memory_interval",
+                          default=env.get(env_opt, 1),
+                          metavar="N",
+                          help="With --color-memory, only measure every "
+                               "Nth test [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_MEMORY_TRACEMALLOC"
+        parser.add_option("--color-memory-tracemalloc", action="store_true",
+                          dest="color_memory_tracemalloc",
+                          default=bool(env.get(env_opt)),
+                          help="With --color-memory, also measure memory "
+                               "allocated by Python, using the tracemalloc "
+                               "module [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_HANG_TIMEOUT"
+        parser.add_option("--color-hang-timeout", action="store",
+                          type="float",
+                          dest="color_hang_timeout",
+                          default=env.get(env_opt, 0),
+                          metavar="SECONDS",
+                          help="Print the stacks of all threads when a test "
+                               "has been running for SECONDS (0, the "
+                               "default, turns this off) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_HANG_REPEAT"
+        parser.add_option("--color-hang-repeat", action="store",
+                          type="float",
+                          dest="color_hang_repeat",
+                          default=env.get(env_opt, 0),
+                          metavar="SECONDS",
+                          help="With --color-hang-timeout, print the stacks "
+                               "again every SECONDS while the test is still "
+                               "running [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_PHASES"
+        parser.add_option("--color-phases", action="store_true",
+                          dest="color_phases",
+                          default=bool(env.get(env_opt)),
+                          help="Report how the time taken by the test run "
+                               "was divided between collection, imports, "
+                               "fixtures, tests and reporting, and the most "
+                               "expensive fixtures [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_FAILURE_BUDGET"
+        parser.add_option("--color-failure-budget", action="store",
+                          type="float",
+                          dest="color_failure_budget",
+                          default=env.get(env_opt, 0),
+                          metavar="MEGABYTES",
+                          help="Keep at most about MEGABYTES of failure "
+                               "reports in memory until the end of the run, "
+                               "moving the rest to temporary files (0, the "
+                               "default, keeps them all in memory) "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_SHARD"
+        parser.add_option("--color-shard", action="store",
+                          type="string",
+                          dest="color_shard",
+                          default=env.get(env_opt),
+                          metavar="I/N",
+                          help="Run only the I'th of N shards of the tests, "
+                               "sharing out test files so that shards take "
+                               "about the same time, using --color-durations "
+                               "if given.  Use --color-record to write the "
+                               "results of each shard, and 'rudolf merge' to "
+                               "report them together [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_DURATIONS"
+        parser.add_option("--color-durations", action="store",
+                          type="string",
+                          dest="color_durations",
+                          default=env.get(env_opt),
+                          metavar="FILE",
+                          help="Test file durations for --color-shard, as "
+                               "written by 'rudolf merge --durations' "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_LOCALS"
+        parser.add_option("--color-locals", action="store",
+                          type="int",
+                          dest="color_locals",
+                          default=env.get(env_opt, 0),
+                          metavar="N",
+                          help="Show the local variables of the innermost N "
+                               "frames of the traceback of each failure and "
+                               "error [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_LOCALS_SIZE"
+        parser.add_option("--color-locals-size", action="store",
+                          type="int",
+                          dest="color_locals_size",
+                          default=env.get(env_opt, 200),
+                          metavar="CHARACTERS",
+                          help="With --color-locals, cut short the values "
+                               "of local variables after this many "
+                               "characters [%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_COMPRESS_IDS"
+        parser.add_option("--color-compress-ids", action="store_true",
+                          dest="color_compress_ids",
+                          default=bool(env.get(env_opt)),
+                          help="Name the module or class of a run of tests "
+                               "once, rather than for every test, in verbose "
+                               "output and the list of problems "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_RESET_AFTER_TEST"
+        parser.add_option("--color-reset-after-test", action="store_true",
+                          dest="color_reset_after_test",
+                          default=bool(env.get(env_opt)),
+                          help="Reset the terminal's colour after every "
+                               "test, for tests that write to the terminal "
+                               "themselves (a run of dots otherwise shares "
+                               "one colour code) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_THREADSAFE"
+        parser.add_option("--color-threadsafe", action="store_true",
+                          dest="color_threadsafe",
+                          default=bool(env.get(env_opt)),
+                          help="Write output safely when tests run in "
+                               "several threads at once, and report how "
+                               "many tests each thread ran (turns off "
+                               "--color-memory, --color-hang-timeout and "
+                               "--color-phases) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_CACHE"
+        parser.add_option("--color-cache", action="store",
+                          type="string",
+                          dest="color_cache",
+                          default=env.get(env_opt),
+                          metavar="FILE",
+                          help="Remember in FILE which source files each "
+                               "test module depends on, and skip test "
+                               "modules that passed last time if none of "
+                               "those files have changed since.  Only runs "
+                               "of the same tests share results "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_FULL_RUN"
+        parser.add_option("--color-full-run", action="store_true",
+                          dest="color_full_run",
+                          default=bool(env.get(env_opt)),
+                          help="With --color-cache, run all the tests, but "
+                               "still update the cache [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_TIMINGS"
+        parser.add_option("--color-timings", action="store",
+                          type="string",
+                          dest="color_timings",
+                          default=env.get(env_opt),
+                          metavar="FILE",
+                          help="Keep how long each test took in the SQLite "
+                               "database FILE, and report the tests that "
+                               "took much longer than usual [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_TIMINGS_THRESHOLD"
+        parser.add_option("--color-timings-threshold", action="store",
+                          type="float",
+                          dest="color_timings_threshold",
+                          default=env.get(env_opt, 1.5),
+                          metavar="FACTOR",
+                          help="With --color-timings, report tests that "
+                               "took FACTOR times longer than usual "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_RERUN"
+        parser.add_option("--color-rerun", action="store",
+                          type="int",
+                          dest="color_rerun",
+                          default=env.get(env_opt, 0),
+                          metavar="K",
+                          help="At the end of the run, run each failed test "
+                               "again, up to K times, and report those that "
+                               "pass as FLAKY rather than as failures "
+                               "[%s]" % env_opt)
 
     def configure(self, options, conf):
         nose.plugins.Plugin.configure(self, options, conf)
@@ -781,6 +2947,52 @@ class ColorOutputPlugin(nose.plugins.Plugin):
             return
 
         self._verbosity = conf.verbosity
+        self._show_all = self._verbosity > 1
+        self._dots = self._verbosity == 1
+        self.watch_interval = float(options.color_watch_interval)
+        self._record_path = options.color_record
+        self._memory = options.color_memory
+        self._memory_interval = int(options.color_memory_interval)
+        self._memory_tracemalloc = options.color_memory_tracemalloc
+        self._hang_timeout = float(options.color_hang_timeout)
+        self._hang_repeat = float(options.color_hang_repeat)
+        self._phases = options.color_phases
+        self._failure_budget = float(options.color_failure_budget)
+        self._locals_frames = int(options.color_locals)
+        self._safe_repr = None
+        if self._locals_frames > 0:
+            self._safe_repr = SafeRepr(int(options.color_locals_size),
+                                       self.locals_time_budget)
+        self._rerun_times = int(options.color_rerun)
+        self._compress_ids = options.color_compress_ids
+        self._reset_after_test = options.color_reset_after_test
+        self._threadsafe = options.color_threadsafe
+        if self._threadsafe:
+            self._turn_off_unsafe_options()
+        self._cache_path = options.color_cache
+        self._full_run = options.color_full_run
+        self._selection = tuple(conf.testNames or ())
+        self._timings_path = options.color_timings
+        self._timings_threshold = float(options.color_timings_threshold)
+        self._config = conf
+        self._working_dir = conf.workingDir
+        self._shard = None
+        if options.color_shard:
+            index, count = parse_shard(options.color_shard)
+            durations = {}
+            if (options.color_durations and
+                os.path.exists(options.color_durations)):
+                durations_file = open(options.color_durations)
+                try:
+                    durations = read_durations(durations_file)
+                finally:
+                    durations_file.close()
+            self._shard = Shard(index - 1, count, durations,
+                                self._working_dir)
+        if (self._parsed_colors is not None and
+            self._parsed_colors[0] == options.colors):
+            # configured again by Watcher: keep the scheme (and formatter)
+            return
         cs = dict(self.default_colorscheme)
         try:
             user_colorscheme = parse_colorscheme(options.colors)
@@ -798,27 +3010,89 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                           (", ".join(unknown_names)))
         cs.update(user_colorscheme)
         self._colorscheme = cs
-        self._show_all = self._verbosity > 1
-        self._dots = self._verbosity == 1
+        self._parsed_colors = options.colors, cs
 
     def begin(self):
+        if self._phases:
+            self._phase_timer = PhaseTimer()
         self._old_failure_exception = doctest.DocTestCase.failureException
+        self._old_doctest_run_test = doctest.DocTestCase.runTest
         # monkeypatch!
         doctest.DocTestCase.failureException = DocTestFailureException
+        doctest.DocTestCase.runTest = run_doctest_case
+        if self._record_path:
+            self._recorder = EventRecorder(self._record_path)
+            if self._threadsafe:
+                self._recorder = ThreadSafeRecorder(self._recorder)
+        if self._memory:
+            if self._memory_tracemalloc and tracemalloc is None:
+                warnings.warn("--color-memory-tracemalloc needs the "
+                              "tracemalloc module (Python 3.4 or newer)",
+                              RuntimeWarning)
+            # the formatter doesn't exist yet
+            describe = lambda test: self._formatter.get_description(test)
+            tracker = MemoryTracker(describe, self._memory_interval,
+                                    self.memory_report_size,
+                                    self._memory_tracemalloc)
+            if tracker.enabled():
+                self._memory_tracker = tracker
+            else:
+                tracker.close()
+                warnings.warn("--color-memory needs %s or the tracemalloc "
+                              "module" % MemoryTracker.statm_path,
+                              RuntimeWarning)
+        if self._hang_timeout > 0:
+            self._watchdog = HangWatchdog(self._report_hang,
+                                          self._hang_timeout,
+                                          self._hang_repeat)
+            self._watchdog.start()
+        if self._cache_path:
+            self._dependency_cache = DependencyCache(self._cache_path,
+                                                     self._selection)
+        if self._timings_path:
+            if sqlite3 is None:
+                warnings.warn("--color-timings needs the sqlite3 module",
+                              RuntimeWarning)
+            else:
+                self._timing_db = TimingDatabase(self._timings_path,
+                                                 self.timing_history,
+                                                 self.timing_keep_runs)
+            self._test_durations = {}
+            self._test_starts = {}
 
     def setOutputStream(self, stream):
         self._stream = stream
+        formatter_key = (self._verbosity, self._colorscheme,
+                         self._compress_ids, self._reset_after_test,
+                         self._threadsafe)
+        if (self._formatter is not None and
+            self._formatter_key == formatter_key):
+            self._formatter.reset(stream)
+            return
+        self._formatter_key = formatter_key
         self._formatter = self.formatter_class(
             self._verbosity,
             True,
             self._colorscheme,
             self._stream,
             clean_tracebacks=self.clean_tracebacks,
-            base_dir=self.base_dir)
+            base_dir=self.base_dir,
+            compress_ids=self._compress_ids,
+            reset_after_test=self._reset_after_test)
+        if self._threadsafe:
+            self._formatter = ThreadSafeFormatter(self._formatter,
+                                                  self._stream)
 
     def prepareTestResult(self, result):
-        result.__failures = []
-        result.__errors = []
+        if self._rerun_times:
+            result.errorClasses[FlakyTest] = [], "FLAKY", False
+            self._rerun_failures = []
+            self._rerun_errors = []
+        if self._failure_budget:
+            self._use_failure_stores(result)
+        else:
+            result.__failures = []
+            result.__errors = []
         result.__tests_run = 0
         result.__start_time = time.time()
         # Python <= 2.6 has _WritelnDecorator at top level
@@ -835,85 +3109,439 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         # Gross, but works.
         old_addSkip = result.addSkip
         def new_addSkip(test, reason):
+            self._finish_test()
             old_addSkip(test, reason)
             label = result.errorClasses[nose.plugins.skip.SkipTest][1]
             self._formatter.test_skip(label)
+            if self._recorder is not None:
+                self._recorder.record(EVENT_SKIP, time.time(), label,
+                                      str(reason))
         result.addSkip = new_addSkip
 
         self._result = result
+        if self._recorder is not None:
+            self._recorder.record(EVENT_BEGIN, result.__start_time,
+                                  LOG_FORMAT_VERSION)
+            if self._shard is not None:
+                self._recorder.record(EVENT_SHARD, result.__start_time,
+                                      self._shard.index + 1,
+                                      self._shard.count)
+            self._file_durations = {}
+            # thread ident: when the last test run in it stopped
+            self._last_stops = {}
+
+    def _turn_off_unsafe_options(self):
+        # these measure one test at a time, which tests running in several
+        # threads at once would muddle
+        for enabled, option in [(self._memory, "--color-memory"),
+                                (self._hang_timeout > 0,
+                                 "--color-hang-timeout"),
+                                (self._phases, "--color-phases")]:
+            if enabled:
+                warnings.warn("%s doesn't work with --color-threadsafe, so "
+                              "it is turned off" % option, RuntimeWarning)
+        self._memory = False
+        self._hang_timeout = 0
+        self._phases = False
+
+    def _use_failure_stores(self, result):
+        # Replace every list that keeps failures until the end of the run
+        # (both ours and nose's) with a FailureStore.
+        self._spill_budget = SpillBudget(
+            int(self._failure_budget * 1024 * 1024))
+        self._failure_stores = []
+        result.__failures = self._new_problem_list()
+        result.__errors = self._new_problem_list()
+        result.failures = self._new_problem_list()
+        result.errors = self._new_problem_list()
+        for cls, (storage, label, isfail) in result.errorClasses.items():
+            store = self._new_problem_list()
+            # error class plugins also keep the storage as an attribute
+            for name, value in vars(result).items():
+                if value is storage:
+                    setattr(result, name, store)
+            result.errorClasses[cls] = store, label, isfail
+
+    def _new_problem_list(self):
+        if not self._failure_budget:
+            return []
+        store = FailureStore(self._spill_budget,
+                             lambda test: self._formatter.get_description(test))
+        self._failure_stores.append(store)
+        return store
+
+    def _locked(self, method, *args):
+        # With --color-threadsafe, tests start and finish in several threads
+        # at once, so the count of tests run and the lists of problems (kept
+        # in step with the ones for --color-rerun) are updated under the
+        # formatter's lock.
+        if not self._threadsafe:
+            return method(*args)
+        self._formatter.lock.acquire()
+        try:
+            return method(*args)
+        finally:
+            self._formatter.lock.release()
 
     def startTest(self, test):
-        self._result.__tests_run = self._result.__tests_run + 1
+        self._locked(self._count_test)
         self._formatter.start_test(test)
+        if self.track_tests:
+            self.test_files.add(source_file(test))
+        if self._recorder is not None:
+            self._recorder.record(EVENT_START, time.time(),
+                                  self._formatter.get_description(test))
+        if self._memory_tracker is not None:
+            self._memory_tracker.start_test(test)
+        if self._watchdog is not None:
+            self._watchdog.start_test(test)
+        if self._phase_timer is not None:
+            self._phase_timer.start_test()
+        if self._timing_db is not None:
+            self._test_starts[test] = time.time()
+        if self._dependency_cache is not None:
+            self._locked(self._dependency_cache.start_test, source_file(test))
+
+    def _count_test(self):
+        self._result.__tests_run = self._result.__tests_run + 1
+
+    def _finish_test(self):
+        # stop the watchdog before the outcome is written
+        if self._watchdog is not None:
+            self._watchdog.stop_test()
+
+    def _report_hang(self, test, elapsed):
+        self._formatter.print_hang_notice(test, elapsed, thread_stacks())
 
     def addSuccess(self, test):
+        self._finish_test()
         self._formatter.test_success(test)
+        if self._recorder is not None:
+            self._recorder.record(EVENT_SUCCESS, time.time())
 
     def addFailure(self, test, err):
+        self._finish_test()
+        self._locked(self._add_failure, test, err)
+
+    def _add_failure(self, test, err):
         formatted_failure = self._exc_info_to_string(err, test)
-        self._result.__failures.append((test, formatted_failure, err[0]))
+        details = getattr(err[1], "doctest_failures", None)
+        # the description, which the report needs, rather than the test
+        recorded = RecordedTest(self._formatter.get_description(test))
+        self._result.__failures.append((recorded, formatted_failure, err[0],
+                                        details))
+        if self._dependency_cache is not None:
+            self._dependency_cache.test_failed(source_file(test))
+        if self._rerun_times:
+            self._rerun_failures.append(self._rerun_entry(test))
         self._formatter.test_failure(test, err)
+        if self.track_tests:
+            self.failed_tests.append(loadable_name(test))
+        if self._recorder is not None:
+            self._recorder.record(
+                EVENT_FAILURE, time.time(), formatted_failure,
+                issubclass(err[0], DocTestFailureException), details)
 
     def addError(self, test, err):
+        self._finish_test()
+        self._locked(self._add_error, test, err)
+
+    def _add_error(self, test, err):
         # If the exception is a registered class, the error will be added to
         # the list for that class, not errors.
-        formatted_err = self._formatter.format_traceback(err)
+        if self._safe_repr is not None:
+            formatted_err = self._format_exception(*err)
+        else:
+            formatted_err = self._formatter.format_traceback(err)
+        recorded = RecordedTest(self._formatter.get_description(test))
         for cls, (storage, label, isfail) in self._result.errorClasses.items():
             if issubclass(err[0], cls):
-                storage.append((test, formatted_err, err[0]))
+                storage.append((recorded, formatted_err, err[0]))
+                if isfail and self._dependency_cache is not None:
+                    self._dependency_cache.test_failed(source_file(test))
                 self._formatter.test_error(test, err, label)
+                self._record_error(err, formatted_err, label, isfail)
                 return
-        self._result.__errors.append((test, formatted_err, err[0]))
+        self._result.__errors.append((recorded, formatted_err, err[0]))
+        if self._dependency_cache is not None:
+            self._dependency_cache.test_failed(source_file(test))
+        if self._rerun_times:
+            self._rerun_errors.append(self._rerun_entry(test))
         self._formatter.test_error(test, err, "ERROR")
+        if self.track_tests:
+            self.failed_tests.append(loadable_name(test))
+        self._record_error(err, formatted_err, "ERROR", True)
+
+    def _rerun_entry(self, test):
+        # kept in step with the failures or errors, which may be on disk by
+        # the time the tests are run again
+        name = rerunnable_name(test)
+        if name is None:
+            return None
+        return name, self._formatter.get_description(test)
+
+    def _record_error(self, err, formatted_err, label, isfail):
+        if self._recorder is not None:
+            self._recorder.record(
+                EVENT_ERROR, time.time(), formatted_err,
+                issubclass(err[0], DocTestFailureException), label, isfail)
 
     def stopTest(self, test):
+        if self._phase_timer is not None:
+            self._phase_timer.stop_test()
+        if self._memory_tracker is not None:
+            self._memory_tracker.stop_test(test)
+        if self._timing_db is not None:
+            start = self._test_starts.pop(test, None)
+            if start is not None:
+                self._test_durations[test.id()] = time.time() - start
         self._formatter.stop_test(test)
+        if self._recorder is not None:
+            now = time.time()
+            self._locked(self._record_duration, test, now)
+            self._recorder.record(EVENT_STOP, now)
+
+    def _record_duration(self, test, now):
+        # Time between tests (imports, fixtures) goes to the next test run
+        # in the same thread, so that shards are balanced on the time their
+        # test files really take.
+        thread = threading.currentThread().ident
+        filename = source_file(test)
+        try:
+            path = self._relative_paths[filename]
+        except KeyError:
+            path = filename
+            if filename is not None:
+                path = relative_location(self._working_dir, filename)
+            self._relative_paths[filename] = path
+        if path is not None:
+            last_stop = self._last_stops.get(thread,
+                                             self._result.__start_time)
+            self._file_durations[path] = (self._file_durations.get(path, 0) +
+                                          now - last_stop)
+        self._last_stops[thread] = now
+
+    def wantFile(self, file):
+        # Leave out test modules that belong to other shards before they
+        # are even imported.
+        if (self._shard is not None and file.endswith(".py") and
+            not self._shard.owns(file)):
+            return False
+        # Likewise those that passed last time and haven't changed.
+        if (self._dependency_cache is not None and not self._full_run and
+            file.endswith(".py") and
+            self._dependency_cache.is_cached(normalize_path(file))):
+            return False
+
+    def prepareTestCase(self, test):
+        # Tests from other kinds of file (e.g. doctest files) are only
+        # found to belong to another shard once loaded: don't run them.
+        if self._shard is not None and not self._shard.owns(source_file(test)):
+            return lambda result: None
+
+    def beforeImport(self, filename, module):
+        if self._phase_timer is not None:
+            self._phase_timer.start_import()
+        if self._dependency_cache is not None:
+            self._dependency_cache.start_loading()
+
+    def afterImport(self, filename, module):
+        if self._phase_timer is not None:
+            self._phase_timer.stop_import()
+        if self._dependency_cache is not None:
+            self._dependency_cache.stop_loading(
+                normalize_path(nose.util.src(filename)), module)
+
+    def startContext(self, context):
+        if self._phase_timer is not None:
+            self._phase_timer.start_context(context)
+        if (self._dependency_cache is not None and
+            isinstance(context, types.ModuleType)):
+            self._dependency_cache.start_loading()
+
+    def stopContext(self, context):
+        if self._phase_timer is not None:
+            self._phase_timer.stop_context(context)
+        if (self._dependency_cache is not None and
+            isinstance(context, types.ModuleType)):
+            self._dependency_cache.stop_loading(source_file(context),
+                                                context.__name__)
 
     def report(self, stream):
+        if self._phase_timer is not None:
+            self._phase_timer.start_report()
+        if self._rerun_times:
+            self._rerun_failed_tests()
         self._print_errors()
-        self._print_summary(self._result.__start_time,
-                            time.time())
+        if self._memory_tracker is not None:
+            self._print_memory_report()
+        if self._timing_db is not None:
+            self._report_timings()
+        if self._dependency_cache is not None:
+            self._dependency_cache.save()
+        if self._threadsafe:
+            self._formatter.print_thread_report()
+        if self._phase_timer is not None:
+            self._phase_timer.stop_report()
+            self._print_phase_report()
+        stop = time.time()
+        self._print_summary(self._result.__start_time, stop)
+        if self._recorder is not None:
+            self._recorder.record(EVENT_DURATIONS, stop, self._file_durations)
+            self._recorder.record(EVENT_END, stop)
         self._result = None
 
     def finalize(self, result):
         self._formatter.stop_tests()
         # remove monkeypatch
         doctest.DocTestCase.failureException = self._old_failure_exception
+        doctest.DocTestCase.runTest = self._old_doctest_run_test
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        if self._memory_tracker is not None:
+            self._memory_tracker.close()
+            self._memory_tracker = None
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+        self._phase_timer = None
+        if self._timing_db is not None:
+            self._timing_db.close()
+            self._timing_db = None
+        self._dependency_cache = None
+        for store in self._failure_stores:
+            store.close()
+        self._failure_stores = []
+
+    def _rerun_failed_tests(self):
+        result = self._result
+        entries = [entry for entry in
+                   self._rerun_failures + self._rerun_errors
+                   if entry is not None]
+        if not entries:
+            return
+        # the tests are loaded afresh, with no plugins, so that nothing
+        # else sees the reruns
+        config = copy.copy(self._config)
+        config.plugins = nose.plugins.manager.PluginManager()
+        loader = nose.loader.TestLoader(config=config)
+        self._formatter.print_rerun_header(len(entries), self._rerun_times)
+        flaky = set()
+        for label, rerun_entries in [("FAIL", self._rerun_failures),
+                                     ("ERROR", self._rerun_errors)]:
+            for entry in rerun_entries:
+                if entry is None:
+                    continue
+                name, description = entry
+                if run_again(loader, name, self._rerun_times):
+                    flaky.add(entry)
+                    self._formatter.print_rerun(description, "FLAKY")
+                    if self._recorder is not None:
+                        self._recorder.record(EVENT_FLAKY, time.time(),
+                                              description)
+                else:
+                    self._formatter.print_rerun(description, label)
+        if not flaky:
+            return
+        flaky_storage = result.errorClasses[FlakyTest][0]
+        result.__failures, result.failures = self._remove_flaky(
+            result.__failures, result.failures, self._rerun_failures, flaky,
+            flaky_storage)
+        result.__errors, result.errors = self._remove_flaky(
+            result.__errors, result.errors, self._rerun_errors, flaky,
+            flaky_storage)
+
+    def _remove_flaky(self, problems, nose_problems, rerun_entries, flaky,
+                      flaky_storage):
+        # Return new versions of our list of problems and nose's, without
+        # the flaky tests, which move to ``flaky_storage``.
+        kept = self._new_problem_list()
+        nose_kept = self._new_problem_list()
+        for problem, nose_problem, entry in itertools.izip(
+            problems, nose_problems, rerun_entries):
+            if entry in flaky:
+                flaky_storage.append(problem)
+            else:
+                kept.append(problem)
+                nose_kept.append(nose_problem)
+        return kept, nose_kept
 
     def _print_errors(self):
-        if self._dots or self._show_all:
-            self._stream.writeln()
-        self._formatter.print_error_list("ERROR", self._result.__errors)
-        self._formatter.print_error_list("FAIL", self._result.__failures)
-        for cls in self._result.errorClasses.keys():
-            storage, label, isfail = self._result.errorClasses[cls]
-            self._formatter.print_error_list(label, storage)
+        self._formatter.print_errors(self._result.__errors,
+                                     self._result.__failures,
+                                     self._result.errorClasses.values())
+
+    def _print_memory_report(self):
+        tracker = self._memory_tracker
+        self._formatter.print_memory_report(
+            tracker.columns, tracker.total_growth(), tracker.largest_tests(),
+            tracker.largest_modules(), tracker.tests_sampled,
+            tracker.tests_seen)
+
+    def _report_timings(self):
+        usual_times = self._timing_db.medians(self.timing_min_samples,
+                                              self._test_durations)
+        regressions = []
+        for name, seconds in self._test_durations.iteritems():
+            usual = usual_times.get(name)
+            if (usual is not None and
+                seconds > usual * self._timings_threshold and
+                seconds - usual >= self.timing_min_seconds):
+                regressions.append((seconds - usual, seconds, usual, name))
+        if regressions:
+            regressions.sort(reverse=True)
+            self._formatter.print_timing_regressions(
+                [regression[1:] for regression in
+                 regressions[:self.timing_report_size]],
+                self.timing_history)
+        self._timing_db.add_run(self._result.__start_time,
+                                self._test_durations)
+        self._test_durations = {}
+
+    def _print_phase_report(self):
+        timer = self._phase_timer
+        self._formatter.print_phase_report(
+            [(phase, timer.totals[phase]) for phase in timer.phases],
+            timer.total(), timer.largest_fixtures(self.fixture_report_size))
 
     def _print_summary(self, start, stop):
         success = self._result.wasSuccessful()
         summary = nose.util.odict()
         if not success:
-            summary["failures"], summary["errors"] = \
-                map(len, [self._result.__failures, self._result.__errors])
-            for cls in self._result.errorClasses.keys():
-                storage, label, isfail = self._result.errorClasses[cls]
-                if not isfail:
-                    continue
-                summary[label] = len(storage)
+            summary = summarize_problems(self._result.__errors,
+                                         self._result.__failures,
+                                         self._result.errorClasses.values())
+        if self._rerun_times:
+            summary["flaky"] = len(self._result.errorClasses[FlakyTest][0])
+        if self._dependency_cache is not None:
+            summary["cached"] = self._dependency_cache.cached_tests
         self._formatter.print_summary(success, summary,
                                       self._result.__tests_run, start, stop)
 
     def _exc_info_to_string(self, err, test):
         exctype, value, tb = err
+        if getattr(value, "doctest_failures", None) is not None:
+            # just the heading: the failed examples are reported from the
+            # record of them
+            value = value.args[0]
         # Skip test runner traceback levels
         while tb and self._is_relevant_tb_level(tb):
             tb = tb.tb_next
         if exctype is test.failureException:
             # Skip assert*() traceback levels
             length = self._count_relevant_tb_levels(tb)
-            return ''.join(traceback.format_exception(exctype, value, tb,
-                                                      length))
-        return ''.join(traceback.format_exception(exctype, value, tb))
+            return self._format_exception(exctype, value, tb, length)
+        return self._format_exception(exctype, value, tb)
+
+    def _format_exception(self, exctype, value, tb, limit=None):
+        if self._safe_repr is None or issubclass(
+            exctype, (DocTestFailureException, doctest.DocTestFailure)):
+            return "".join(traceback.format_exception(exctype, value, tb,
+                                                      limit))
+        return format_exception_with_locals(exctype, value, tb, limit,
+                                            self._locals_frames,
+                                            self._safe_repr)
 
     def _is_relevant_tb_level(self, tb):
         return tb.tb_frame.f_globals.has_key('__unittest')
@@ -926,6 +3554,440 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         return length
 
 
+def changed_files(before, after):
+    """Return the paths that were added, removed or modified between two
+    {path: modification time} snapshots.
+
+    >>> changes = changed_files({"a": 1, "b": 2, "c": 3}, {"a": 1, "b": 5,
+    ...                                                    "d": 1})
+    >>> sorted(changes)
+    ['b', 'c', 'd']
+    """
+    changed = set(before) ^ set(after)
+    for path, mtime in after.iteritems():
+        if before.get(path, mtime) != mtime:
+            changed.add(path)
+    return changed
+
+
+class Watcher(object):
+    """Run tests, then run them again in-process whenever files change.
+
+    The same plugin instance is used for every run, so the colour scheme
+    and output formatter are only set up once.  After a change, only the
+    tests from changed test modules and the tests that failed last time are
+    run.  If a file that no known test was loaded from changes, all the
+    tests are run again, since we can't tell which tests depend on it.
+    """
+
+    extensions = (".py", ".rst", ".txt")
+
+    def __init__(self, argv, plugin=None, stream=sys.stderr, env=os.environ):
+        if plugin is None:
+            plugin = ColorOutputPlugin()
+        plugin.track_tests = True
+        self._plugin = plugin
+        self._stream = stream
+        self._env = env
+        parser = self._make_config().getParser()
+        options, self.names = parser.parse_args(argv[1:])
+        self._argv = [argv[0], "--with-color"] + [
+            arg for arg in argv[1:] if arg not in self.names]
+        self._directories = []
+        for name in self.names or [options.workingDir or os.getcwd()]:
+            path = name.split(":")[0]
+            if not os.path.isdir(path):
+                path = os.path.dirname(path) or os.curdir
+            self._directories.append(normalize_path(path))
+        self._failed_tests = []
+        # modules that were imported before any tests ran (this one, nose
+        # and whatever imported them) are never forgotten
+        self._preloaded = set(sys.modules)
+
+    def _make_config(self):
+        manager = nose.plugins.manager.BuiltinPluginManager(
+            plugins=[self._plugin])
+        return nose.config.Config(env=self._env,
+                                  files=nose.config.all_config_files(),
+                                  plugins=manager, stream=self._stream)
+
+    def snapshot(self):
+        """Return the modification times of the files being watched."""
+        mtimes = {}
+        for directory in self._directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                dirnames[:] = [name for name in dirnames
+                               if not name.startswith(".")]
+                for filename in filenames:
+                    if not filename.endswith(self.extensions):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        # removed while we were looking
+                        pass
+        return mtimes
+
+    def run(self, names):
+        """Run the named tests in-process, returning True on success."""
+        self._plugin.failed_tests = []
+        program = nose.core.TestProgram(argv=self._argv + names,
+                                        config=self._make_config(),
+                                        exit=False)
+        self._failed_tests = self._plugin.failed_tests
+        return program.success
+
+    def rerun(self, changed):
+        """Run the tests affected by the ``changed`` files."""
+        self._forget_modules(changed)
+        names = self.select(changed)
+        if names is None:
+            names = self.names
+        return self.run(names)
+
+    def select(self, changed):
+        """Return the names of the tests to run after ``changed`` files have
+        changed, or None if all of the tests should be run."""
+        names = []
+        for path in sorted(changed):
+            if path not in self._plugin.test_files:
+                return None
+            if os.path.exists(path):
+                names.append(path)
+        for name in self._failed_tests:
+            if name.split(":")[0] not in changed:
+                names.append(name)
+        return names
+
+    def _forget_modules(self, changed):
+        # So that nose imports the new code.  Modules that didn't change
+        # still hold references to the old versions of the ones that did, so
+        # everything the tests loaded from the watched directories goes.
+        for name, module in sys.modules.items():
+            filename = getattr(module, "__file__", None)
+            if filename is None:
+                continue
+            path = normalize_path(nose.util.src(filename))
+            if path in changed or (name not in self._preloaded and
+                                   self._is_watched(path)):
+                del sys.modules[name]
+
+    def _is_watched(self, path):
+        for directory in self._directories:
+            if path.startswith(os.path.join(directory, "")):
+                return True
+        return False
+
+    def watch(self):
+        """Run the tests, then keep polling for changes until interrupted."""
+        self.run(self.names)
+        before = self.snapshot()
+        try:
+            while True:
+                time.sleep(self._plugin.watch_interval)
+                after = self.snapshot()
+                changed = changed_files(before, after)
+                if changed:
+                    before = after
+                    self._stream.write("\n")
+                    self.rerun(changed)
+        except KeyboardInterrupt:
+            self._stream.write("\n")
+
+
+def watch(argv):
+    """Run ``rudolf watch``: the arguments are the same as for nosetests."""
+    Watcher(argv).watch()
+    return 0
+
+
+def replay_log(log_file, formatter):
+    """Render the test runs recorded in an open log file.
+
+    Events are read and rendered one at a time, so only the problems to be
+    reported at the end of each run are kept in memory.  A run that was cut
+    short is reported up to its last recorded event.  Returns True if all
+    the runs were successful.
+    """
+    all_successful = True
+    run = None
+    test = None
+    event = None
+    # the most frequent events come first
+    for event in read_events(log_file):
+        code = event[0]
+        if code == EVENT_START:
+            test = RecordedTest(event[2])
+            run.tests_run += 1
+            formatter.start_test(test)
+        elif code == EVENT_SUCCESS:
+            formatter.test_success(test)
+        elif code == EVENT_STOP:
+            formatter.stop_test(test)
+        elif code == EVENT_FAILURE:
+            run.add_problem(test, event)
+            formatter.test_failure(test, None)
+        elif code == EVENT_ERROR:
+            formatter.test_error(test, None, run.add_problem(test, event))
+        elif code == EVENT_SKIP:
+            formatter.test_skip(run.add_problem(test, event))
+        elif code == EVENT_FLAKY:
+            run.mark_flaky(event[2])
+        elif code == EVENT_BEGIN:
+            run = _RecordedRun(event[1])
+        elif code == EVENT_END:
+            all_successful = run.report(event[1], formatter) and all_successful
+            run = None
+    if run is not None:
+        all_successful = run.report(event[1], formatter) and all_successful
+    return all_successful
+
+
+def _recorded_problem(test, event):
+    formatted, is_doctest = event[2:4]
+    err_type = is_doctest and DocTestFailureException or Exception
+    if event[0] == EVENT_FAILURE and len(event) > 4:
+        return test, formatted, err_type, event[4]
+    return test, formatted, err_type
+
+
+class _RecordedRun(object):
+
+    def __init__(self, start):
+        self.start = start
+        self.tests_run = 0
+        self.errors = []
+        self.failures = []
+        self.error_classes = nose.util.odict()
+
+    def error_class_storage(self, label, isfail):
+        try:
+            return self.error_classes[label][0]
+        except KeyError:
+            storage = []
+            self.error_classes[label] = storage, label, isfail
+            return storage
+
+    def add_problem(self, test, event):
+        """Keep the problem recorded by ``event`` for the report.
+
+        Returns the label of the problem.
+        """
+        code = event[0]
+        if code == EVENT_SKIP:
+            label, reason = event[2:4]
+            self.error_class_storage(label, False).append((test, reason))
+            return label
+        problem = _recorded_problem(test, event)
+        if code == EVENT_FAILURE:
+            self.failures.append(problem)
+            return "FAIL"
+        label, isfail = event[4:6]
+        if label == "ERROR":
+            self.errors.append(problem)
+        else:
+            self.error_class_storage(label, isfail).append(problem)
+        return label
+
+    def merge(self, other):
+        """Add the tests and problems of the run ``other`` to this one."""
+        self.tests_run += other.tests_run
+        self.errors.extend(other.errors)
+        self.failures.extend(other.failures)
+        for storage, label, isfail in other.error_classes.values():
+            self.error_class_storage(label, isfail).extend(storage)
+
+    def mark_flaky(self, description):
+        """Move the failure or error of the test described by
+        ``description``, which passed when run again, to the FLAKY
+        problems."""
+        for problems in self.failures, self.errors:
+            for index, problem in enumerate(problems):
+                if str(problem[0]) == description:
+                    del problems[index]
+                    self.error_class_storage("FLAKY", False).append(problem)
+                    return
+
+    def report(self, stop, formatter, shards=None):
+        error_classes = self.error_classes.values()
+        success = not (self.errors or self.failures or
+                       [storage for storage, label, isfail in error_classes
+                        if isfail and storage])
+        summary = nose.util.odict()
+        if not success:
+            summary = summarize_problems(self.errors, self.failures,
+                                         error_classes)
+        if "FLAKY" in self.error_classes:
+            summary["flaky"] = len(self.error_classes["FLAKY"][0])
+        formatter.print_errors(self.errors, self.failures, error_classes)
+        if shards:
+            formatter.print_shard_report(shards)
+        formatter.print_summary(success, summary, self.tests_run, self.start,
+                                stop)
+        formatter.stop_tests()
+        return success
+
+
+def merge_logs(log_files, formatter, durations=None):
+    """Report the runs of the shards of a test run as one test run.
+
+    ``log_files`` is a sequence of (name, open log file) pairs, each
+    written by --color-record for one shard; the name is used for shards
+    not run with --color-shard.  Each shard is taken to have started at the
+    same time, so the merged run took as long as the slowest shard.  If
+    ``durations`` is given, the test file durations recorded by the shards
+    are added to it.  Returns True if all the shards were successful.
+
+    --color-record appends to its log, so a log holds every run of its
+    shard made in the same place; only the last of them is merged.
+    """
+    merged = _RecordedRun(0)
+    shards = []
+    for log_name, log_file in log_files:
+        run = _RecordedRun(0)
+        name = log_name
+        stop = 0
+        shard_durations = {}
+        test = None
+        for event in read_events(log_file):
+            code = event[0]
+            if code == EVENT_START:
+                test = RecordedTest(event[2])
+                run.tests_run += 1
+            elif code in (EVENT_FAILURE, EVENT_ERROR, EVENT_SKIP):
+                run.add_problem(test, event)
+            elif code == EVENT_FLAKY:
+                run.mark_flaky(event[2])
+            elif code == EVENT_SHARD:
+                name = "%d/%d" % event[2:4]
+            elif code == EVENT_DURATIONS:
+                shard_durations = event[2]
+            elif code == EVENT_BEGIN:
+                # forget any earlier run of the shard
+                run = _RecordedRun(event[1])
+                name = log_name
+                shard_durations = {}
+            stop = event[1]
+        merged.merge(run)
+        if durations is not None:
+            durations.update(shard_durations)
+        shards.append((name, run.tests_run, stop - run.start))
+    critical_path = max([0] + [seconds for name, tests_run, seconds
+                               in shards])
+    return merged.report(critical_path, formatter, shards)
+
+
+def _add_formatter_options(parser):
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      default=1, help="Be more verbose")
+    parser.add_option("--verbosity", action="store", type="int",
+                      dest="verbosity", help="Set verbosity")
+    parser.add_option("-q", "--quiet", action="store_const", const=0,
+                      dest="verbosity", help="Be less verbose")
+    parser.add_option("--colors", action="store", type="string",
+                      default=os.environ.get("NOSE_COLORS", ""),
+                      help="Colour scheme, as for nosetests --colors")
+    parser.add_option("--clean-tracebacks", action="store_true",
+                      default=False,
+                      help="Shorten paths in tracebacks relative to "
+                           "--base-dir, eliding paths outside it")
+    parser.add_option("--base-dir", action="store", default=os.curdir,
+                      help="Base directory for --clean-tracebacks")
+    parser.add_option("--compress-ids", action="store_true", default=False,
+                      help="Name the module or class of a run of tests "
+                           "once, as for nosetests --color-compress-ids")
+
+
+def _make_formatter(parser, options):
+    colorscheme = dict(ColorOutputPlugin.default_colorscheme)
+    try:
+        colorscheme.update(parse_colorscheme(options.colors))
+    except ValueError, exc:
+        parser.error("bad --colors: %s" % exc)
+    return ColorfulOutputFormatter(
+        options.verbosity, True, colorscheme, sys.stdout,
+        clean_tracebacks=options.clean_tracebacks,
+        base_dir=options.base_dir, compress_ids=options.compress_ids)
+
+
+def replay(argv):
+    """Run ``rudolf replay``: render a log written by --color-record."""
+    parser = optparse.OptionParser(
+        usage="%prog replay [options] LOG",
+        description="Render the test runs recorded in LOG (see the "
+                    "--color-record option of nosetests --with-color) "
+                    "without running the tests again.")
+    _add_formatter_options(parser)
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("expected exactly one log file")
+    formatter = _make_formatter(parser, options)
+    log_file = open(args[0], "rb")
+    try:
+        success = replay_log(log_file, formatter)
+    finally:
+        log_file.close()
+    return not success and 1 or 0
+
+
+def merge(argv):
+    """Run ``rudolf merge``: report the logs of the shards of a test run."""
+    parser = optparse.OptionParser(
+        usage="%prog merge [options] LOG...",
+        description="Report the runs recorded in the LOGs (see the "
+                    "--color-shard and --color-record options of nosetests "
+                    "--with-color) as one test run.")
+    _add_formatter_options(parser)
+    parser.add_option("--durations", action="store", metavar="FILE",
+                      help="Update FILE with the test file durations "
+                           "recorded by the shards, for --color-durations")
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("expected at least one log file")
+    formatter = _make_formatter(parser, options)
+    durations = None
+    if options.durations:
+        durations = {}
+        if os.path.exists(options.durations):
+            durations_file = open(options.durations)
+            try:
+                durations = read_durations(durations_file)
+            finally:
+                durations_file.close()
+    log_files = []
+    try:
+        for filename in args:
+            log_files.append((os.path.basename(filename),
+                              open(filename, "rb")))
+        success = merge_logs(log_files, formatter, durations)
+    finally:
+        for name, log_file in log_files:
+            log_file.close()
+    if durations is not None:
+        durations_file = open(options.durations, "w")
+        try:
+            write_durations(durations_file, durations)
+        finally:
+            durations_file.close()
+    return not success and 1 or 0
+
+
+commands = {"merge": merge, "replay": replay, "watch": watch}
+
+
+def main(argv=None):
+    """Entry point for the ``rudolf`` command."""
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2 or argv[1] not in commands:
+        sys.stderr.write("usage: %s COMMAND [ARGUMENTS]\n"
+                         "commands: %s\n" % (os.path.basename(argv[0]),
+                                             ", ".join(sorted(commands))))
+        return 2
+    return commands[argv[1]](argv[1:])
+
+
 # classes for use in rudolf's own tests
 
 
@@ -933,8 +3995,8 @@ class TestColorfulOutputFormatter(ColorfulOutputFormatter):
 
     __test__ = False
 
-    def _format_seconds(self, n_seconds, normal="normal"):
-        return "%s seconds" % (self.colorize("number", "...", normal))
+    def _format_seconds(self, n_seconds):
+        return [("number", "..."), ("normal", " seconds")]
 
 
 class TestColorOutputPlugin(ColorOutputPlugin):